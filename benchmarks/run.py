@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Benchmark generate-workflows.py and setup_downstream_ci.py end-to-end on synthetic
+dependency trees, see synthetic.py.
+
+Both scripts run as subprocesses, the way CI runs them. The setup script fetches the
+ci-configs from a local HTTP server serving the synthetic mirror, see mirror_server.py.
+Wall-clock time (best of --repeat runs) and peak memory (max RSS) are recorded per tree
+size, as well as the cold start time of the setup script, i.e. importing it.
+
+Times are compared to baselines relative to a calibration run, a fixed python workload
+timed on the same machine, so baselines of a faster or slower machine still apply.
+
+Usage:
+    python benchmarks/run.py                       # run and print results
+    python benchmarks/run.py --check               # fail on regression vs baselines
+    python benchmarks/run.py --update-baselines    # store results as new baselines
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import yaml_io  # noqa: E402
+from mirror_server import serve_mirror  # noqa: E402
+from synthetic import write_synthetic_tree  # noqa: E402
+
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+SIZES = [50, 500, 5000]
+# differences below these are noise, whatever the relative tolerance
+MIN_TIME_DIFF = 0.1  # seconds
+MIN_MEMORY_DIFF = 5.0  # MiB
+# fixed workload timing the machine, see calibrate
+CALIBRATION = "sorted(str(i) for i in range(10**6))"
+# linux limit on the length of a single environment variable (MAX_ARG_STRLEN)
+MAX_ENV_VAR_LENGTH = 32 * 4096 - 1
+
+
+def run(cmd: list[str], cwd: Path, env: dict) -> tuple[float, float]:
+    """Run a command, returns its wall-clock time in s and max RSS in MiB."""
+    # stderr goes to a file, a pipe nobody reads blocks the process once full
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=stderr
+        )
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            stderr.seek(0)
+            sys.exit(f"{' '.join(cmd)} failed:\n{stderr.read().decode()}")
+    # ru_maxrss is in KiB on linux, bytes on macOS
+    maxrss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return elapsed, maxrss
+
+
+def setup_env(workflow: Path, root: Path, dep_tree: dict, base_url: str) -> dict:
+    """Environment of the setup step of a generated workflow, with no inputs set."""
+    with open(workflow, "r") as f:
+        steps = yaml_io.load(f)["jobs"]["setup"]["steps"]
+    step_env = next(s for s in steps if s.get("id") == "setup")["env"]
+    env = {k: re.sub(r"\$\{\{.*?\}\}", "", str(v)) for k, v in step_env.items()}
+    trigger = next(iter(dep_tree))
+    env.update(
+        {
+            "GITHUB_REPOSITORY": f"ecmwf/{trigger}",
+            "GITHUB_REF_NAME": "develop",
+            "GITHUB_OUTPUT": str(root / "github_output"),
+            "CONFIG_BASE_URL": base_url,
+            "CONFIG_CACHE_DIR": "",
+        }
+    )
+    return {**os.environ, **env}
+
+
+def benchmark(size: int, repeat: int, latency: float) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        dep_tree = write_synthetic_tree(size, root)
+        server = serve_mirror(root / "mirror", latency)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        (root / "workflows").mkdir()
+        generate_cmd = [
+            sys.executable,
+            str(REPO_ROOT / "generate-workflows.py"),
+            "--config",
+            "config.yml",
+            "--dep-tree",
+            "dependency_tree.yml",
+            "--output",
+            "workflows",
+            "--force",
+        ]
+        setup_cmd = [sys.executable, str(REPO_ROOT / "setup_downstream_ci.py")]
+        # cold start of the setup step: interpreter start up and imports only
+        import_cmd = [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {str(REPO_ROOT)!r}); "
+            "import setup_downstream_ci",
+        ]
+
+        results = {}
+        for name, cmd, env in [
+            ("generate", generate_cmd, None),
+            ("setup_import", import_cmd, None),
+            ("setup", setup_cmd, "downstream-ci"),
+            ("setup_hpc", setup_cmd, "downstream-ci-hpc"),
+        ]:
+            if env:
+                env = setup_env(
+                    root / "workflows" / f"{env}.yml", root, dep_tree, base_url
+                )
+                too_long = [k for k, v in env.items() if len(v) > MAX_ENV_VAR_LENGTH]
+                if too_long:
+                    print(
+                        f"{size:>6} packages: {name} can't run, environment variables "
+                        f"{too_long} exceed {MAX_ENV_VAR_LENGTH} bytes"
+                    )
+                    continue
+            runs = [run(cmd, root, env) for _ in range(repeat)]
+            results[f"{name}_s"] = round(min(r[0] for r in runs), 3)
+            results[f"{name}_peak_mib"] = round(max(r[1] for r in runs), 1)
+        server.shutdown()
+    return results
+
+
+def calibrate(repeat: int) -> float:
+    """Best time of the calibration workload in s, see CALIBRATION."""
+    cmd = [sys.executable, "-c", CALIBRATION]
+    return round(min(run(cmd, REPO_ROOT, None)[0] for _ in range(repeat)), 3)
+
+
+def scale_times(results: dict, factor: float) -> dict:
+    return {
+        size: {
+            metric: round(value * factor, 3) if metric.endswith("_s") else value
+            for metric, value in metrics.items()
+        }
+        for size, metrics in results.items()
+    }
+
+
+def regressions(
+    results: dict, baselines: dict, tolerance: float, calibration: float
+) -> list[str]:
+    """
+    Results worse than their baselines, times scaled by how much slower the
+    calibration run is than the one of the baselines.
+    """
+    factor = calibration / baselines.get("calibration_s", calibration)
+    found = []
+    for size, metrics in results.items():
+        for metric, value in metrics.items():
+            baseline = baselines.get(size, {}).get(metric)
+            if baseline is None:
+                continue
+            if metric.endswith("_s"):
+                baseline = round(baseline * factor, 3)
+            min_diff = MIN_TIME_DIFF if metric.endswith("_s") else MIN_MEMORY_DIFF
+            if value > baseline * (1 + tolerance) and value - baseline > min_diff:
+                found.append(
+                    f"{size} packages, {metric}: {value} > baseline {baseline}"
+                )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="*", type=int, default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Latency of the config server in s."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="Allowed relative slowdown/memory growth against baselines.",
+    )
+    parser.add_argument("--check", action="store_true", help="Fail on regressions.")
+    parser.add_argument("--update-baselines", action="store_true")
+    parser.add_argument("--json", help="Write results to given file.")
+    args = parser.parse_args()
+
+    # at least 3 runs, the calibration scales all times
+    calibration = calibrate(max(args.repeat, 3))
+    print(f"calibration_s={calibration}")
+
+    def print_results(size):
+        print(
+            f"{size:>6} packages: "
+            + ", ".join(f"{k}={v}" for k, v in results[str(size)].items())
+        )
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = benchmark(size, args.repeat, args.latency)
+        print_results(size)
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    if args.check:
+        # a regression has to show again, a single slow benchmark is noise
+        for size in args.sizes:
+            metrics = results[str(size)]
+            if regressions(
+                {str(size): metrics}, baselines, args.tolerance, calibration
+            ):
+                print(f"{size:>6} packages: regressed, running again")
+                again = benchmark(size, args.repeat, args.latency)
+                results[str(size)] = {k: min(v, again[k]) for k, v in metrics.items()}
+                print_results(size)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baselines:
+        # keep all baselines relative to the same calibration
+        baselines.setdefault("calibration_s", calibration)
+        baselines.update(scale_times(results, baselines["calibration_s"] / calibration))
+        BASELINES.write_text(json.dumps(baselines, indent=2) + "\n")
+        print(f"Baselines written to {BASELINES}")
+    elif args.check:
+        if found := regressions(results, baselines, args.tolerance, calibration):
+            print("Regressions:", *found, sep="\n  ")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Generate synthetic dependency_tree.yml / config.yml pairs, together with the ci-config
+files of the packages laid out as <owner>/<repo>/<ref>/<path>.
+
+Trees are layered, every package depends on 1-4 packages of the layers below it,
+mostly on the layer right below. A share of packages are python packages, private,
+have per-workflow overrides, opt in to optional matrix entries or skip platforms.
+Generation is deterministic for given size and seed.
+"""
+
+import math
+import random
+from pathlib import Path
+
+import yaml_io
+
+PLATFORMS = [
+    ("gnu@debian-11", "debian-11", "gnu"),
+    ("gnu@rocky-8.6", "rocky-8.6", "gnu"),
+    ("clang@rocky-8.6", "rocky-8.6", "clang"),
+    ("gnu@ubuntu-22.04", "ubuntu-22.04", "gnu"),
+    ("gnu@fedora-37", "fedora-37", "gnu"),
+]
+OPTIONAL_PLATFORMS = [
+    ("gnu@debian-12", "debian-12", "gnu"),
+    ("clang@macos-13-arm", "macos-13-arm", "clang"),
+    ("clang@macos-13-x86", "macos-13-x86", "clang"),
+]
+HPC_PLATFORMS = ["gnu-12.2.0", "gnu-8.5.0", "nvidia-22.11", "intel-2021.4.0"]
+
+
+def _matrix_entry(name, os_name, compiler):
+    return {
+        "name": name,
+        "labels": ["self-hosted", f"platform-builder-{os_name}"],
+        "os": os_name,
+        "compiler": compiler,
+        "compiler_cc": "gcc" if compiler == "gnu" else "clang",
+        "compiler_cxx": "g++" if compiler == "gnu" else "clang++",
+        "compiler_fc": "gfortran",
+    }
+
+
+def _hpc_entry(name):
+    return {
+        "name": name,
+        "site": "atos",
+        "compiler": name,
+        "compiler_modules": name.replace("-", "/"),
+    }
+
+
+def generate_config() -> dict:
+    downstream_ci = {
+        "type": "build-package",
+        "repo": "ecmwf-actions/downstream-ci",
+        "python_qa": True,
+        "clang_format": True,
+        "python_versions": ["3.10", "3.12"],
+        "matrix": {
+            "name": [p[0] for p in PLATFORMS],
+            "include": [_matrix_entry(*p) for p in PLATFORMS],
+        },
+        "optional_matrix": {
+            "name": [p[0] for p in OPTIONAL_PLATFORMS],
+            "include": [_matrix_entry(*p) for p in OPTIONAL_PLATFORMS],
+        },
+    }
+    downstream_ci_hpc = {
+        "type": "build-package-hpc",
+        "repo": "ecmwf-actions/downstream-ci",
+        "python_jobs": ["gnu-8.5.0"],
+        "python_versions": ["3.10"],
+        "matrix": {
+            "name": HPC_PLATFORMS,
+            "include": [_hpc_entry(p) for p in HPC_PLATFORMS],
+        },
+        "optional_matrix": {
+            "name": ["lumi-gnu-12.2.0"],
+            "include": [_hpc_entry("lumi-gnu-12.2.0")],
+        },
+    }
+    return {
+        "downstream-ci": downstream_ci,
+        "downstream-ci-hpc": downstream_ci_hpc,
+        "private-downstream-ci": {
+            **downstream_ci,
+            "repo": "ecmwf-actions/private-downstream-ci",
+            "private": True,
+        },
+        "private-downstream-ci-hpc": {
+            **downstream_ci_hpc,
+            "repo": "ecmwf-actions/private-downstream-ci",
+            "private": True,
+        },
+    }
+
+
+def generate_dep_tree(size: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    depth = min(size, 4 + 2 * int(math.log10(size)))
+    layers: list[list[str]] = [[] for _ in range(depth)]
+    for i in range(size):
+        # first package of every layer guarantees the full depth
+        layer = i if i < depth else rng.randrange(depth)
+        layers[layer].append(f"pkg-{i:05d}")
+
+    dep_tree = {}
+    for level, packages in enumerate(layers):
+        for package in packages:
+            conf = {"type": "python" if level and rng.random() < 0.3 else "cmake"}
+            if level:
+                below = layers[level - 1]
+                lower = [p for layer in layers[: level - 1] for p in layer]
+                deps = {rng.choice(below)}
+                for _ in range(rng.randint(0, 3)):
+                    deps.add(
+                        rng.choice(lower)
+                        if lower and rng.random() < 0.4
+                        else rng.choice(below)
+                    )
+                conf["deps"] = sorted(deps)
+                if rng.random() < 0.1:
+                    conf["downstream-ci"] = {"deps": sorted(deps)[:1]}
+            if rng.random() < 0.3:
+                conf["master_branch"] = "main"
+            if rng.random() < 0.05:
+                conf["private"] = True
+            if conf["type"] == "cmake" and rng.random() < 0.1:
+                conf["optional_matrix"] = [p[0] for p in OPTIONAL_PLATFORMS]
+            if rng.random() < 0.1:
+                conf["downstream-ci-hpc"] = {"skip": ["nvidia-22.11"]}
+            if conf["type"] == "python" and rng.random() < 0.5:
+                conf.setdefault("downstream-ci", {})["config_path"] = ""
+            dep_tree[package] = conf
+
+    # deterministic, but not in dependency order, like the real tree
+    packages = sorted(dep_tree)
+    rng.shuffle(packages)
+    return {package: dep_tree[package] for package in packages}
+
+
+def write_ci_configs(dep_tree: dict, root: Path, seed: int = 0):
+    """Write ci-config files of all packages for both develop and master type refs."""
+    rng = random.Random(seed)
+    configs = [
+        yaml_io.dump({"build": {"self_build": True}}),
+        yaml_io.dump({"build": {"self_build": True}, "matrix": ["default", "debug"]}),
+    ]
+    for package, conf in dep_tree.items():
+        for ref in ("develop", conf.get("master_branch", "master")):
+            directory = root / "ecmwf" / package / ref / ".github"
+            directory.mkdir(parents=True, exist_ok=True)
+            for name in ("ci-config.yml", "ci-hpc-config.yml"):
+                (directory / name).write_text(configs[rng.random() < 0.2])
+
+
+def write_synthetic_tree(size: int, root: Path, seed: int = 0) -> dict:
+    """
+    Write dependency_tree.yml, config.yml, ci-groups.yml and a ci-config mirror for
+    given number of packages into root. Returns the dependency tree.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    dep_tree = generate_dep_tree(size, seed)
+    with open(root / "dependency_tree.yml", "w") as f:
+        yaml_io.dump(dep_tree, f, sort_keys=False)
+    with open(root / "config.yml", "w") as f:
+        yaml_io.dump(generate_config(), f, sort_keys=False)
+    with open(root / "ci-groups.yml", "w") as f:
+        yaml_io.dump({"all": None, "all_python": None, "all_cmake": None}, f)
+    write_ci_configs(dep_tree, root / "mirror", seed)
+    return dep_tree
@@ -0,0 +1,75 @@
+"""
+Covering arrays of build matrices, to test every t-wise interaction of matrix values
+with fewer jobs than the full product.
+
+config.yml may set the strength of the covering arrays of a workflow:
+    ```
+    covering_strength: 2        pairwise, every pair of values of any two axes of a
+                                package matrix, e.g. platform and python version, is
+                                built together in at least one job
+    ```
+Matrices of triggering packages are never reduced. Combinations left out of a matrix
+are listed in its `exclude`. Arrays are built greedily, picking the combination which
+covers the most uncovered t-tuples, the first one in product order on ties, so the same
+matrix is always reduced the same way.
+"""
+
+import itertools
+import math
+
+# matrix keys which are not axes
+NON_AXES = ("include", "exclude")
+
+
+def matrix_axes(matrix: dict) -> dict[str, list]:
+    return {
+        key: values
+        for key, values in matrix.items()
+        if key not in NON_AXES and isinstance(values, list)
+    }
+
+
+def covering_array(sizes: list[int], strength: int) -> list[tuple[int, ...]]:
+    """
+    Combinations of value indices of axes of the given sizes, covering every
+    combination of values of any `strength` axes, in product order.
+    """
+    strength = min(strength, len(sizes))
+    groups = list(itertools.combinations(range(len(sizes)), strength))
+    uncovered = {
+        (group, values)
+        for group in groups
+        for values in itertools.product(*(range(sizes[i]) for i in group))
+    }
+    candidates = list(itertools.product(*(range(size) for size in sizes)))
+
+    def covers(candidate):
+        return [(g, tuple(candidate[i] for i in g)) for g in groups]
+
+    rows = []
+    while uncovered:
+        best = max(candidates, key=lambda c: sum(t in uncovered for t in covers(c)))
+        rows.append(best)
+        uncovered.difference_update(covers(best))
+    return sorted(rows)
+
+
+def reduce_matrix(matrix: dict, strength: int) -> tuple[int, int]:
+    """
+    Exclude combinations of a matrix in place, keeping a covering array of the given
+    strength. Returns the number of jobs of the full and of the reduced matrix.
+    """
+    axes = matrix_axes(matrix)
+    sizes = [len(values) for values in axes.values()]
+    full = math.prod(sizes)
+    if sum(size > 1 for size in sizes) <= strength:
+        return full, full
+    kept = set(covering_array(sizes, strength))
+    exclude = [
+        {key: values[i] for (key, values), i in zip(axes.items(), combination)}
+        for combination in itertools.product(*(range(size) for size in sizes))
+        if combination not in kept
+    ]
+    if exclude:
+        matrix["exclude"] = matrix.get("exclude", []) + exclude
+    return full, len(kept)
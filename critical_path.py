@@ -0,0 +1,160 @@
+"""
+Critical path analysis of the jobs of a workflow.
+
+Jobs are weighted with durations from a history file, a yaml object with durations in
+seconds per package (job name) and matrix entry name:
+    ```
+    default: 600                  Optional, duration of jobs without history
+    eckit:
+        gnu@debian-11: 900
+        gnu@rocky-8.6: 840
+    setup: 30
+    ```
+or from a job_history.py database, taking the median duration of successful jobs.
+A job with a matrix finishes when its slowest matrix entry does, so the duration of
+a job is the maximum over the matrix entries of the workflow. Jobs are assumed to
+start as soon as all of their needs have finished.
+"""
+
+from dataclasses import dataclass
+
+import yaml_io
+from job_history import JobHistory
+
+DEFAULT_DURATION = 600  # seconds
+SQLITE_HEADER = b"SQLite format 3\0"
+
+
+@dataclass
+class JobTiming:
+    duration: float
+    earliest_start: float = 0
+    latest_start: float = 0
+
+    @property
+    def earliest_finish(self) -> float:
+        return self.earliest_start + self.duration
+
+    @property
+    def slack(self) -> float:
+        """How much the job can be delayed without delaying the whole workflow."""
+        return self.latest_start - self.earliest_start
+
+
+@dataclass
+class CriticalPath:
+    timings: dict[str, JobTiming]
+    path: list[str]
+
+    @property
+    def makespan(self) -> float:
+        return max((t.earliest_finish for t in self.timings.values()), default=0)
+
+
+def load_durations(path: str) -> dict:
+    with open(path, "rb") as f:
+        if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+            history = JobHistory(path)
+            try:
+                return history.durations()
+            finally:
+                history.close()
+    with open(path, "r") as f:
+        return yaml_io.load(f) or {}
+
+
+def job_duration(durations: dict, job: str, platforms: list[str]) -> float:
+    """Duration of a job, the slowest of its matrix entries on given platforms."""
+    default = durations.get("default", DEFAULT_DURATION)
+    history = durations.get(job)
+    if history is None:
+        return default
+    if not isinstance(history, dict):
+        return history
+    known = [history[platform] for platform in platforms if platform in history]
+    return max(known) if known else history.get("default", default)
+
+
+def _topological_order(needs: dict[str, list[str]]) -> list[str]:
+    order = []
+    done = set()
+    for root in needs:
+        stack = [(root, iter(needs[root]))]
+        while stack:
+            job, children = stack[-1]
+            for need in children:
+                if need not in done and need in needs:
+                    stack.append((need, iter(needs[need])))
+                    break
+            else:
+                stack.pop()
+                if job not in done:
+                    done.add(job)
+                    order.append(job)
+    return order
+
+
+def analyse(needs: dict[str, list[str]], durations: dict[str, float]) -> CriticalPath:
+    """
+    Compute earliest and latest start of every job and the critical path, given the
+    needs and duration of every job.
+    """
+    order = _topological_order(needs)
+    timings = {job: JobTiming(durations[job]) for job in order}
+    for job in order:
+        timings[job].earliest_start = max(
+            (timings[n].earliest_finish for n in needs[job] if n in timings),
+            default=0,
+        )
+
+    makespan = max((t.earliest_finish for t in timings.values()), default=0)
+    latest_finish = {job: makespan for job in order}
+    for job in reversed(order):
+        timing = timings[job]
+        timing.latest_start = latest_finish[job] - timing.duration
+        for need in needs[job]:
+            if need in latest_finish:
+                latest_finish[need] = min(latest_finish[need], timing.latest_start)
+
+    path = []
+    if order:
+        job = max(order, key=lambda j: timings[j].earliest_finish)
+        while job is not None:
+            path.append(job)
+            start = timings[job].earliest_start
+            job = next(
+                (
+                    n
+                    for n in needs[job]
+                    if n in timings and timings[n].earliest_finish == start
+                ),
+                None,
+            )
+        path.reverse()
+    return CriticalPath(timings, path)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_report(name: str, result: CriticalPath) -> str:
+    lines = [
+        f"{name}: predicted makespan {format_duration(result.makespan)}",
+        "  critical path: "
+        + " -> ".join(
+            f"{job} ({format_duration(result.timings[job].duration)})"
+            for job in result.path
+        ),
+    ]
+    with_slack = sorted(
+        (t.slack, job) for job, t in result.timings.items() if job not in result.path
+    )
+    if with_slack:
+        lines.append(
+            "  least slack: "
+            + ", ".join(f"{job} ({format_duration(s)})" for s, job in with_slack[:10])
+        )
+    return "\n".join(lines)
@@ -0,0 +1,133 @@
+"""
+Dependency graph of the packages in dependency_tree.yml.
+
+The graph is built once per (dependency tree, workflow name) pair. Per-workflow `deps`
+overrides are applied while building it, so every query below answers for that
+workflow only. The transitive closure of every package is precomputed, so repeated
+lookups during workflow generation are cheap.
+"""
+
+from typing import Literal
+
+
+class DependencyCycleError(ValueError):
+    """Raised when dependency_tree.yml contains a dependency cycle."""
+
+    def __init__(self, wf_name: str, path: list[str]):
+        self.wf_name = wf_name
+        self.path = path
+        super().__init__(
+            f"Dependency cycle detected in {wf_name or 'dependency tree'}: "
+            + " -> ".join(path)
+        )
+
+
+class DependencyGraph:
+    def __init__(self, dep_tree: dict, wf_name: str):
+        self.dep_tree = dep_tree
+        self.wf_name = wf_name
+        self._direct: dict[str, list[str]] = {}
+        self._closure: dict[str, list[str]] = {}
+        self._dependents: dict[str, list[str]] | None = None
+        self.topological_order: list[str] = []
+        self._build()
+
+    def direct_deps(self, package: str) -> list[str]:
+        """Direct dependencies of a package, honouring workflow specific `deps`."""
+        if package not in self._direct:
+            conf = self.dep_tree.get(package)
+            if conf is None:
+                self._direct[package] = []
+            else:
+                self._direct[package] = (
+                    conf.get(self.wf_name, {}).get("deps") or conf.get("deps") or []
+                )
+        return self._direct[package]
+
+    def deps(self, package: str) -> list[str]:
+        """
+        Transitive dependencies of a package. Every package is listed after all of
+        the packages which depend on it.
+        """
+        return self._closure.get(package, [])
+
+    def type_deps(self, package: str, type: Literal["cmake", "python"]) -> list[str]:
+        return [
+            dep
+            for dep in self.deps(package)
+            if (self.dep_tree.get(dep) or {}).get("type", "cmake") == type
+        ]
+
+    def dependents(self, package: str) -> list[str]:
+        """Transitive dependents of a package, i.e. packages affected by its change."""
+        if self._dependents is None:
+            self._dependents = {}
+            for pkg in self.topological_order:
+                for dep in self.deps(pkg):
+                    self._dependents.setdefault(dep, []).append(pkg)
+        return self._dependents.get(package, [])
+
+    def affected(self, packages: list[str]) -> list[str]:
+        """Given packages and all of their dependents, in topological order."""
+        affected = set(packages)
+        for package in packages:
+            affected.update(self.dependents(package))
+        return [pkg for pkg in self.topological_order if pkg in affected]
+
+    def _build(self):
+        # iterative DFS, post-order gives the topological order (deps first)
+        state: dict[str, Literal["visiting", "done"]] = {}
+        for root in self.dep_tree:
+            if root in state:
+                continue
+            stack = [(root, iter(self.direct_deps(root)))]
+            path = [root]
+            state[root] = "visiting"
+            while stack:
+                package, children = stack[-1]
+                for dep in children:
+                    if state.get(dep) == "visiting":
+                        cycle_start = path.index(dep)
+                        raise DependencyCycleError(
+                            self.wf_name, path[cycle_start:] + [dep]
+                        )
+                    if dep not in state:
+                        state[dep] = "visiting"
+                        stack.append((dep, iter(self.direct_deps(dep))))
+                        path.append(dep)
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+                    state[package] = "done"
+                    self._closure[package] = self._merge_closures(package)
+                    if package in self.dep_tree:
+                        self.topological_order.append(package)
+
+    def _merge_closures(self, package: str) -> list[str]:
+        # Equivalent to walking the tree depth first and moving every revisited
+        # dependency to the end of the list, which is the order workflows have
+        # always been generated with. A dependency's position is decided by the
+        # last direct dependency whose subtree contains it.
+        segments = []
+        seen = set()
+        for dep in reversed(self.direct_deps(package)):
+            segment = [d for d in [dep] + self._closure.get(dep, []) if d not in seen]
+            seen.update(segment)
+            segments.append(segment)
+        return [dep for segment in reversed(segments) for dep in segment]
+
+
+_graphs: dict[tuple[int, str], DependencyGraph] = {}
+
+
+def get_dep_graph(dep_tree: dict, wf_name: str) -> DependencyGraph:
+    """
+    Get the dependency graph for given workflow name, building it on first use.
+    The dep tree must not be modified once its graph has been built.
+    """
+    graph = _graphs.get((id(dep_tree), wf_name))
+    if graph is None or graph.dep_tree is not dep_tree:
+        graph = DependencyGraph(dep_tree, wf_name)
+        _graphs[(id(dep_tree), wf_name)] = graph
+    return graph
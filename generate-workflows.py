@@ -1,46 +1,80 @@
 #!/usr/bin/env python
 
 import argparse
-from pathlib import PurePath
+import hashlib
+import json
+import re
+import sys
+from pathlib import Path
 from typing import Literal
-import yaml
 
 from dataclasses import dataclass, field
 
+import critical_path
+import dependency_graph
+import matrix_entries
+import yaml_io
+from dependency_graph import DependencyCycleError, DependencyGraph, get_dep_graph
+from matrix_entries import package_entries, platform_slug
 
-# modify how pyyaml dumps multiline strings - we want `|`
-def str_presenter(dumper, data):
-    if len(data.splitlines()) > 1:  # check for multiline string
-        return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+# persisted between runs of the setup job by actions/cache
+CONFIG_CACHE_DIR = "~/.cache/downstream-ci/ci-config"
 
+# generated workflows are regenerated whenever any of these files change
+GENERATOR_SOURCES = [
+    __file__,
+    critical_path.__file__,
+    dependency_graph.__file__,
+    matrix_entries.__file__,
+    yaml_io.__file__,
+]
+FINGERPRINT_PREFIX = "# Fingerprint: "
+# github rejects expressions longer than this
+MAX_EXPRESSION_LENGTH = 20000
+CLANG_FORMAT_VERSION = "19.1.7"
+# timing spans of the setup script, uploaded as an artifact, see timing.py
+SETUP_TIMINGS_FILE = "setup-timings.json"
+# checkers run concurrently, their output is printed in turn once they are done
+PYTHON_QA_SCRIPT = """\
+export PATH=~/python-qa/bin:$PATH
+if [ "${{ inputs.python_qa_changed_only }}" = "true" ] && git cat-file -e "$BASE_SHA^{commit}" 2>/dev/null
+then
+    mapfile -t files < <(git diff --name-only --diff-filter=d "$BASE_SHA...HEAD" -- "*.py")
+    echo "Checking ${#files[@]} files changed since $BASE_SHA"
+    if [ ${#files[@]} -eq 0 ]; then
+        exit 0
+    fi
+else
+    files=(.)
+fi
 
-yaml.add_representer(str, str_presenter)
-yaml.emitter.Emitter.prepare_tag = lambda self, tag: ""
+logs=$(mktemp -d)
+declare -A pids
+isort --check --profile black --filter-files "${files[@]}" > $logs/isort 2>&1 &
+pids[isort]=$!
+black --check "${files[@]}" > $logs/black 2>&1 &
+pids[black]=$!
+flake8 "${files[@]}" > $logs/flake8 2>&1 &
+pids[flake8]=$!
 
+failed=0
+for tool in isort black flake8; do
+    wait ${pids[$tool]}
+    status=$?
+    echo "::group::$tool"
+    cat $logs/$tool
+    echo "::endgroup::"
+    if [ $status -ne 0 ]; then
+        echo "::error::$tool failed"
+        failed=1
+    fi
+done
+exit $failed
+"""
 
-def get_package_deps(
-    package: str, dep_tree: dict, wf_name: str, deps: list[str] = None
-):
-    if deps is None:
-        deps = []
-    if package not in dep_tree or dep_tree[package] is None:
-        return deps
-
-    direct_deps = (
-        dep_tree[package].get(wf_name, {}).get("deps")
-        or dep_tree[package].get("deps")
-        or []
-    )
 
-    for dep in direct_deps:
-        if dep in deps:
-            deps.remove(dep)
-        deps.append(dep)
-        if dep in dep_tree:
-            get_package_deps(dep, dep_tree, wf_name, deps)
-
-    return deps
+def get_package_deps(package: str, dep_tree: dict, wf_name: str) -> list[str]:
+    return list(get_dep_graph(dep_tree, wf_name).deps(package))
 
 
 def tree_get_package_var(
@@ -59,12 +93,7 @@ def tree_get_package_var(
 def get_type_deps(
     package: str, dep_tree: dict, wf_name, type: Literal["cmake", "python"]
 ):
-    package_deps = get_package_deps(package, dep_tree, wf_name)
-    type_deps = []
-    for dep in package_deps:
-        if dep_tree[dep].get("type", "cmake") == type:
-            type_deps.append(dep)
-    return type_deps
+    return get_dep_graph(dep_tree, wf_name).type_deps(package, type)
 
 
 def is_input(package, dep_tree, wf_name, wf_private) -> bool:
@@ -85,6 +114,12 @@ class Job:
     runs_on: str | list[str] = "ubuntu-latest"
     steps: list[dict] = field(default_factory=list)
     outputs: dict = None
+    # job calling a reusable workflow instead of running steps
+    uses: str = None
+    with_inputs: dict = None
+    secrets: str | dict = None
+    # key of the job in the workflow, if it differs from its name
+    id: str = None
 
     def __getstate__(self) -> object:
         d = {"name": self.name}
@@ -92,6 +127,13 @@ class Job:
             d["needs"] = self.needs
         if self.condition:
             d["if"] = self.condition
+        if self.uses:
+            d["uses"] = self.uses
+            if self.with_inputs:
+                d["with"] = self.with_inputs
+            if self.secrets:
+                d["secrets"] = self.secrets
+            return d
         if self.strategy:
             d["strategy"] = self.strategy
         if self.env:
@@ -111,9 +153,40 @@ class Workflow:
     inputs: dict = field(default_factory=dict)
     jobs: dict[str, Job] = field(default_factory=dict)
     private: bool = False
+    # name of the shard if this is a reusable workflow with part of the package jobs
+    shard: str = None
+    # platform group of every package, when matrices are compact
+    platform_groups: dict[str, str] = None
+    # whether package jobs get a build key from setup
+    build_keys: bool = False
+    # whether matrix entries skip when a dependency failed on the same entry
+    platform_isolation: bool = False
+    # matrix entries every package may build on, with a job per package and entry
+    # instead of a job per package, see platform_job_id
+    package_platforms: dict[str, list[str]] = None
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.name}-{self.shard}.yml" if self.shard else f"{self.name}.yml"
+
+    @property
+    def setup_outputs(self) -> str:
+        """Expression prefix of setup job outputs, shards get them as inputs."""
+        return "inputs" if self.shard else "needs.setup.outputs"
+
+    @property
+    def setup_wf_name(self) -> str:
+        """Workflow name the setup script looks up package variables with."""
+        match self.name:
+            case "private-downstream-ci":
+                return "downstream-ci"
+            case "private-downstream-ci-hpc":
+                return "downstream-ci-hpc"
+            case _:
+                return self.name
 
     def add_job(self, job: Job):
-        self.jobs[job.name] = job
+        self.jobs[job.id or job.name] = job
 
     # generate inputs - runner type specific inputs + list of packages
     #   read config for specific inputs and dep tree for packages
@@ -137,6 +210,12 @@ class Workflow:
         return c
 
     def __getstate__(self) -> object:
+        if self.shard:
+            return {
+                "name": f"{self.name} ({self.shard})",
+                "on": {"workflow_call": {"inputs": self.inputs}},
+                "jobs": self.jobs,
+            }
         d = {
             "name": self.name,
             "on": {"workflow_call": {"inputs": self.inputs}},
@@ -179,7 +258,13 @@ class Workflow:
             "type": "boolean",
             "required": False,
         }
+        self.inputs["python_qa_changed_only"] = {
+            "description": "Whether to check only files changed against the base ref.",
+            "type": "boolean",
+            "required": False,
+        }
 
+        # the tools are unpinned, a weekly cache key picks up new releases
         steps = [
             {
                 "name": "Checkout Repository",
@@ -187,23 +272,49 @@ class Workflow:
                 "with": {
                     "repository": "${{ inputs.repository }}",
                     "ref": "${{ inputs.ref }}",
+                    "fetch-depth": "${{ !inputs.python_qa_changed_only && 1 || 0 }}",
                 },
             },
             {
                 "name": "Setup Python",
+                "id": "setup-python",
                 "uses": "actions/setup-python@v4",
                 "with": {"python-version": "3.x"},
             },
+            {
+                "name": "Get Week",
+                "id": "week",
+                "run": 'echo "week=$(date -u +%G-%V)" >> $GITHUB_OUTPUT',
+            },
+            {
+                "name": "Cache Python Dependencies",
+                "id": "cache-python-qa",
+                "uses": "actions/cache@v4",
+                "with": {
+                    "path": "~/python-qa",
+                    "key": "python-qa-${{ runner.os }}"
+                    + "-${{ steps.setup-python.outputs.python-version }}"
+                    + "-${{ steps.week.outputs.week }}",
+                },
+            },
             {
                 "name": "Install Python Dependencies",
+                "if": "steps.cache-python-qa.outputs.cache-hit != 'true'",
                 "run": (
-                    "python -m pip install --upgrade pip\n"
-                    "python -m pip install black flake8 isort\n"
+                    "python -m venv ~/python-qa\n"
+                    "~/python-qa/bin/python -m pip install --upgrade pip\n"
+                    "~/python-qa/bin/python -m pip install black flake8 isort\n"
                 ),
             },
-            {"name": "Check isort", "run": "isort --check . --profile black"},
-            {"name": "Check black", "run": "black --check ."},
-            {"name": "Check flake8", "run": "flake8 ."},
+            {
+                "name": "Check isort, black and flake8",
+                "shell": "bash {0}",
+                "env": {
+                    "BASE_SHA": "${{ github.event.pull_request.base.sha"
+                    + " || github.event.before }}"
+                },
+                "run": PYTHON_QA_SCRIPT,
+            },
         ]
 
         job = Job(
@@ -225,25 +336,39 @@ class Workflow:
             "type": "string",
             "required": False,
         }
+        self.inputs["clang_format_changed_only"] = {
+            "description": "Whether to check only files changed against the base ref.",
+            "type": "boolean",
+            "required": False,
+        }
 
+        # clang-format comes as a wheel from pypi, which is cached between runs
         steps = r"""
                 - name: Checkout repository
                   uses: actions/checkout@v4
+                  with:
+                    fetch-depth: ${{ !inputs.clang_format_changed_only && 1 || 0 }}
+
+                - name: Cache clang-format
+                  id: cache-clang-format
+                  uses: actions/cache@v4
+                  with:
+                    path: ~/clang-format
+                    key: clang-format-VERSION-${{ runner.os }}-${{ runner.arch }}
 
                 - name: Install clang-format
-                  run: |
-                    wget -O - https://apt.llvm.org/llvm-snapshot.gpg.key | sudo apt-key add -
-                    sudo add-apt-repository deb http://apt.llvm.org/jammy/ llvm-toolchain-jammy-19 main
-                    sudo apt update
-                    sudo apt install -y clang-format-19
+                  if: steps.cache-clang-format.outputs.cache-hit != 'true'
+                  run: python3 -m pip install --target ~/clang-format clang-format==VERSION
 
                 - name: Run clang-format
                   shell: bash {0}
+                  env:
+                    BASE_SHA: ${{ github.event.pull_request.base.sha || github.event.before }}
                   run: |
+                    export CLANG_FORMAT=~/clang-format/clang_format/data/bin/clang-format
+                    $CLANG_FORMAT --version
                     ignore="./\($(echo "${{ inputs.clang_format_ignore }}" | sed ':a;N;$!ba;s/\n/\\|/g')\)"
                     echo "Ignore: $ignore"
-                    files=$(find . -not \( -regex $ignore -prune \) -regex ".*\.\(cpp\|hpp\|cc\|cxx\|h\|c\)")
-                    errors=0
 
                     if [ ! -e ".clang-format" ]
                     then
@@ -251,12 +376,20 @@ class Workflow:
                         exit 1
                     fi
 
-                    for file in $files; do
-                        clang-format-19 --dry-run --Werror --style=file --fallback-style=none $file
-                        if [ $? -ne 0 ]; then
-                            ((errors++))
-                        fi
-                    done
+                    if [ "${{ inputs.clang_format_changed_only }}" = "true" ] && git cat-file -e "$BASE_SHA^{commit}" 2>/dev/null
+                    then
+                        echo "Checking files changed since $BASE_SHA"
+                        files=$(git diff --name-only --diff-filter=d "$BASE_SHA...HEAD" | sed 's|^|./|' | grep -e "\.\(cpp\|hpp\|cc\|cxx\|h\|c\)$" | grep -v -e "^$ignore\(/.*\)\?$")
+                    else
+                        files=$(find . -not \( -regex $ignore -prune \) -regex ".*\.\(cpp\|hpp\|cc\|cxx\|h\|c\)")
+                    fi
+                    echo "Checking $(echo "$files" | grep -c .) files on $(nproc) cores"
+
+                    failed=$(echo "$files" | grep . | xargs -r -d '\n' -n 16 -P "$(nproc)" sh -c '
+                        for file; do
+                            $CLANG_FORMAT --dry-run --Werror --style=file --fallback-style=none "$file" || echo "$file"
+                        done' sh)
+                    errors=$(echo "$failed" | grep -c .)
 
                     if [ $errors -ne 0 ]; then
                         echo "::error::clang-format failed for $errors files"
@@ -267,26 +400,35 @@ class Workflow:
                 name="clang-format",
                 needs=["setup"],
                 condition="${{ inputs.clang_format }}",
-                steps=yaml.safe_load(steps),
+                steps=yaml_io.load(steps.replace("VERSION", CLANG_FORMAT_VERSION)),
             )
         )
 
-    def generate_package_jobs(self, dep_tree: dict):
+    def generate_package_jobs(self, dep_tree: dict, packages: list[str] = None):
+        """
+        Add a job for every package, or for given packages only. Jobs of a shard only
+        need jobs of the same shard, its caller runs it after setup and other shards.
+        """
+        graph = get_dep_graph(dep_tree, self.name)
         for package, pkg_conf in dep_tree.items():
             if not is_input(package, dep_tree, self.name, self.private):
                 continue
+            if packages is not None and package not in packages:
+                continue
             if self.private != tree_get_package_var(
                 "private", dep_tree, package, self.name, False
             ):
                 continue
-            package_deps = get_package_deps(package, dep_tree, self.name)
+            package_deps = graph.deps(package)
+            # github.job is the job id, which names the platform as well
+            job_ref = f"'{package}'" if self.package_platforms else "github.job"
             cmake_deps = [
-                "${{ " + f"needs.setup.outputs.{dep}" + " }}"
-                for dep in get_type_deps(package, dep_tree, self.name, "cmake")
+                "${{ " + f"{self.setup_outputs}.{dep}" + " }}"
+                for dep in graph.type_deps(package, "cmake")
                 if is_input(dep, dep_tree, self.name, self.private)
             ]
             python_deps = []
-            for dep in get_type_deps(package, dep_tree, self.name, "python"):
+            for dep in graph.type_deps(package, "python"):
                 if is_input(dep, dep_tree, self.name, self.private):
                     # Python deps need a default input value for ci-python
                     # because there's no ci-config for it. ==>
@@ -309,8 +451,8 @@ class Workflow:
 
                     python_deps.append(
                         "${{ "
-                        + f"needs.setup.outputs.{dep} || "
-                        + "(needs.setup.outputs.use_master == 'True' && "
+                        + f"{self.setup_outputs}.{dep} || "
+                        + f"({self.setup_outputs}.use_master == 'True' && "
                         + f"'{dep}:{dep_repo}@{master_branch}') || "
                         + f"'{dep}:{dep_repo}@{develop_branch}'"
                         + " }}"
@@ -322,34 +464,55 @@ class Workflow:
                 if is_input(dep, dep_tree, self.name, self.private)
                 and self.private
                 == tree_get_package_var("private", dep_tree, dep, self.name, False)
+                and (packages is None or dep in packages)
             ]
             condition_inputs = " || ".join(
                 [
-                    f"needs.setup.outputs.{dep}"
+                    f"{self.setup_outputs}.{dep}"
                     for dep in package_deps
                     if is_input(dep, dep_tree, self.name, self.private)
                 ]
-                + [f"needs.setup.outputs.{package}"]
+                + [f"{self.setup_outputs}.{package}"]
             )
-            needs.append("setup")
+            if not self.shard:
+                needs.append("setup")
 
             condition = (
                 "${{ (always() && !cancelled()) "
-                "&& contains(join(needs.*.result, ','), 'success') "
-                f"&& needs.setup.outputs.{package}_matrix "
+                + (
+                    ""
+                    if self.shard
+                    else "&& contains(join(needs.*.result, ','), 'success') "
+                )
+                + f"&& {self.setup_outputs}.{package}_matrix "
                 f"&& ({condition_inputs})"
-                f"&& contains(fromJson(needs.setup.outputs.ci_group_pkgs), '{package}')"
+                f"&& contains(fromJson({self.setup_outputs}.ci_group_pkgs), '{package}')"
                 " }}"
             )
-            strategy = {
-                "fail-fast": False,
-                "matrix": "${{ "
-                + f"fromJson(needs.setup.outputs.{package}_matrix)"
-                + " }}",
-            }
+            if self.platform_groups:
+                # compact matrices are the members of the matrix object, their
+                # include lists are shared by all packages of a platform group
+                matrix = (
+                    "fromJson(format('{{{0},\"include\":{1}}}', "
+                    f"{self.setup_outputs}.{package}_matrix, "
+                    f"{self.setup_outputs}.platforms_{self.platform_groups[package]}))"
+                )
+            else:
+                matrix = f"fromJson({self.setup_outputs}.{package}_matrix)"
+            strategy = {"fail-fast": False, "matrix": "${{ " + matrix + " }}"}
             runs_on = "${{ matrix.labels }}"
             package_env = tree_get_package_var("env", dep_tree, package, self.name)
-            env = {"DEP_TREE": "${{ needs.setup.outputs.dep_tree }}"}
+            env = {
+                "DEP_TREE": "${{ " + f"{self.setup_outputs}.{package}_dep_tree" + " }}"
+            }
+            if self.build_keys:
+                env["BUILD_KEY"] = (
+                    "${{ "
+                    + f"fromJson({self.setup_outputs}.build_keys)"
+                    + f"['{package}'][matrix.name]"
+                    + "[format('{0}/{1}', matrix.config, matrix.python_version)]"
+                    + " }}"
+                )
             env.update(package_env) if package_env else None
             test_cmd = tree_get_package_var("test_cmd", dep_tree, package, self.name)
             mkdir = tree_get_package_var("mkdir", dep_tree, package, self.name) or []
@@ -362,7 +525,8 @@ class Workflow:
             steps = []
             if self.wf_type == "build-package":
                 if pkg_conf.get("type", "cmake") == "cmake":
-                    needs.append("clang-format")
+                    if not self.shard:
+                        needs.append("clang-format")
                     s = {
                         "uses": (
                             "ecmwf-actions/reusable-workflows/"
@@ -382,8 +546,8 @@ class Workflow:
                             "codecov_token"
                         ] = "${{ secrets.CODECOV_UPLOAD_TOKEN }}"
                         s["with"]["codecov_upload"] = (
-                            "${{ contains(needs.setup.outputs.trigger_pkgs, "
-                            "github.job) && inputs.codecov_upload }}"
+                            "${{ " + f"contains({self.setup_outputs}.trigger_pkgs, "
+                            f"{job_ref}) && inputs.codecov_upload }}}}"
                         )
                     else:
                         s["with"]["github_token"] = "${{ secrets.GH_REPO_READ_TOKEN }}"
@@ -391,7 +555,8 @@ class Workflow:
                         s["with"]["python_version"] = build_package_python
                     steps.append(s)
                 if pkg_conf.get("type", "cmake") == "python":
-                    needs.append("python-qa")
+                    if not self.shard:
+                        needs.append("python-qa")
                     if len(cmake_deps):
                         # python package with cmake deps
                         s = {
@@ -447,9 +612,9 @@ class Workflow:
                             ci_python_step["with"]["conda_install"] = conda_deps
                         if not self.private:
                             ci_python_step["with"]["codecov_upload"] = (
-                                "${{ contains(needs.setup.outputs.trigger_pkgs, "
-                                "github.job) && inputs.codecov_upload "
-                                "&& needs.setup.outputs.py_codecov_platform "
+                                "${{ " + f"contains({self.setup_outputs}.trigger_pkgs, "
+                                f"{job_ref}) && inputs.codecov_upload "
+                                f"&& {self.setup_outputs}.py_codecov_platform "
                                 "== matrix.name }}"
                             )
                             ci_python_step["with"][
@@ -484,9 +649,9 @@ class Workflow:
                             ci_python_step["with"]["conda_install"] = conda_deps
                         if not self.private:
                             ci_python_step["with"]["codecov_upload"] = (
-                                "${{ contains(needs.setup.outputs.trigger_pkgs, "
-                                "github.job) && inputs.codecov_upload "
-                                "&& needs.setup.outputs.py_codecov_platform "
+                                "${{ " + f"contains({self.setup_outputs}.trigger_pkgs, "
+                                f"{job_ref}) && inputs.codecov_upload "
+                                f"&& {self.setup_outputs}.py_codecov_platform "
                                 "== matrix.name }}"
                             )
                             ci_python_step["with"][
@@ -524,7 +689,307 @@ class Workflow:
                 if conda_deps:
                     s["with"]["conda_deps"] = conda_deps
                 steps.append(s)
-            self.add_job(Job(package, needs, condition, strategy, env, runs_on, steps))
+            if self.platform_isolation:
+                steps = self.platform_isolation_steps(
+                    package,
+                    [
+                        dep
+                        for dep in package_deps
+                        if is_input(dep, dep_tree, self.name, self.private)
+                        and self.private
+                        == tree_get_package_var(
+                            "private", dep_tree, dep, self.name, False
+                        )
+                    ],
+                    steps,
+                )
+            if not self.package_platforms:
+                self.add_job(
+                    Job(package, needs, condition, strategy, env, runs_on, steps)
+                )
+                continue
+            matrix_output = f"{self.setup_outputs}.{package}_matrix"
+            for platform in self.package_platforms[package]:
+                platform_output = (
+                    f"{self.setup_outputs}.{package}_{platform_slug(platform)}_matrix"
+                )
+                self.add_job(
+                    Job(
+                        package,
+                        [
+                            (
+                                platform_job_id(need, platform)
+                                if need in self.package_platforms
+                                else need
+                            )
+                            for need in needs
+                            if platform in self.package_platforms.get(need, [platform])
+                        ],
+                        condition.replace(matrix_output, platform_output),
+                        {
+                            **strategy,
+                            "matrix": "${{ fromJson(" + platform_output + ") }}",
+                        },
+                        env,
+                        runs_on,
+                        steps,
+                        id=platform_job_id(package, platform),
+                    )
+                )
+
+    def platform_isolation_steps(
+        self, package: str, deps: list[str], steps: list[dict]
+    ) -> list[dict]:
+        """
+        Wrap the steps of a package job, so that a matrix entry is skipped if one of
+        the package's dependencies failed or was skipped on the same entry. Failed
+        and skipped entries upload a marker artifact, named after the package, matrix
+        entry name and run attempt, which dependents look for. Markers list the
+        packages which failed, so skipped entries of dependents name the cause. A
+        skipped entry stays green, with a warning, and is built again when the failed
+        job is re-run, as dependent jobs are re-run with it.
+        """
+        marker = (
+            "downstream-failed_{}_${{{{ matrix.name }}}}_${{{{ github.run_attempt }}}}"
+        )
+        failed_file = "${{ runner.temp }}/failed"
+        wrapped = []
+        upload_condition = "${{ failure() }}"
+        if deps:
+            # minimatch only expands braces with more than one alternative
+            pattern = deps[0] if len(deps) == 1 else "{" + ",".join(deps) + "}"
+            wrapped += [
+                {
+                    "name": "Download upstream failures",
+                    "continue-on-error": True,
+                    "uses": "actions/download-artifact@v4",
+                    "with": {
+                        "pattern": marker.format(pattern) + "_*",
+                        "path": "${{ runner.temp }}/upstream-failed",
+                    },
+                },
+                {
+                    "name": "Check upstream status",
+                    "id": "upstream",
+                    "shell": "bash",
+                    "run": (
+                        'failed="$(cat ${{ runner.temp }}/upstream-failed/*/* '
+                        '2>/dev/null | sort -u | xargs)"\n'
+                        'if [ -n "$failed" ]; then\n'
+                        '    echo "::warning::Skipped on ${{ matrix.name }}, upstream '
+                        'failed: $failed"\n'
+                        '    echo "Skipped ${{ github.job }} on ${{ matrix.name }}, '
+                        'upstream failed: $failed" >> $GITHUB_STEP_SUMMARY\n'
+                        f'    echo "$failed" | tr " " "\\n" > "{failed_file}"\n'
+                        '    echo "failed=$failed" >> $GITHUB_OUTPUT\n'
+                        "fi\n"
+                    ),
+                },
+            ]
+            skip = "steps.upstream.outputs.failed == ''"
+            for step in steps:
+                condition = skip
+                if "if" in step:
+                    existing = step["if"].removeprefix("${{").removesuffix("}}")
+                    condition += f" && ({existing.strip()})"
+                wrapped.append({"if": "${{ " + condition + " }}", **step})
+            upload_condition = "${{ failure() || steps.upstream.outputs.failed != '' }}"
+        else:
+            wrapped += steps
+        wrapped += [
+            {
+                "name": "Record failure",
+                "if": "${{ failure() }}",
+                "shell": "bash",
+                "run": f'echo {package} > "{failed_file}"',
+            },
+            {
+                "name": "Upload failure",
+                "if": upload_condition,
+                "uses": "actions/upload-artifact@v4",
+                "with": {
+                    "name": marker.format(package) + "_${{ strategy.job-index }}",
+                    "path": failed_file,
+                    "retention-days": 1,
+                },
+            },
+        ]
+        return wrapped
+
+    def generate_shards(
+        self, dep_tree: dict, wf_config: dict, ci_groups: dict, downstream_ci_ref: str
+    ) -> list["Workflow"]:
+        """
+        Move package jobs into one reusable workflow per shard, see partition_packages,
+        each called by a job of this workflow. Setup outputs and inputs used by jobs
+        of a shard are passed to it as inputs. A shard runs after the shards it
+        depends on, and is skipped when none of its packages are to be built.
+        """
+        graph = get_dep_graph(dep_tree, self.name)
+        packages = [
+            package
+            for package in dep_tree
+            if is_input(package, dep_tree, self.name, self.private)
+            and self.private
+            == tree_get_package_var("private", dep_tree, package, self.name, False)
+        ]
+        shards = partition_packages(packages, graph, wf_config["shard"], ci_groups)
+        shard_of = {pkg: shard for shard, pkgs in shards.items() for pkg in pkgs}
+        setup_outputs = self.jobs["setup"].outputs
+        workflows = []
+        for shard, shard_packages in shards.items():
+            wf = Workflow(
+                self.name,
+                self.wf_type,
+                private=self.private,
+                shard=shard,
+                platform_groups=self.platform_groups,
+                build_keys=self.build_keys,
+                platform_isolation=self.platform_isolation,
+            )
+            wf.generate_package_jobs(dep_tree, shard_packages)
+            used = set(
+                re.findall(
+                    r"\binputs\.([\w-]+)",
+                    yaml_io.dump(wf.jobs, block_strings=True, width=float("inf")),
+                )
+            )
+            with_inputs = {}
+            for name in [*setup_outputs, *self.inputs]:
+                if name not in used or name in with_inputs:
+                    continue
+                if name in setup_outputs:
+                    wf.inputs[name] = {"required": False, "type": "string"}
+                    with_inputs[name] = "${{ " + f"needs.setup.outputs.{name}" + " }}"
+                else:
+                    wf.inputs[name] = self.inputs[name]
+                    with_inputs[name] = "${{ " + f"inputs.{name}" + " }}"
+
+            needs = ["setup"]
+            if self.wf_type == "build-package":
+                for package in shard_packages:
+                    qa_job = (
+                        "python-qa"
+                        if dep_tree[package].get("type", "cmake") == "python"
+                        else "clang-format"
+                    )
+                    if qa_job not in needs:
+                        needs.append(qa_job)
+            for package in shard_packages:
+                for dep in graph.deps(package):
+                    dep_shard = shard_of.get(dep, shard)
+                    if dep_shard != shard and f"shard-{dep_shard}" not in needs:
+                        needs.append(f"shard-{dep_shard}")
+
+            condition = (
+                "(always() && !cancelled()) "
+                "&& contains(join(needs.*.result, ','), 'success')"
+            )
+            in_scope = " || ".join(
+                f"(needs.setup.outputs.{package}_matrix && "
+                f"contains(fromJson(needs.setup.outputs.ci_group_pkgs), '{package}'))"
+                for package in shard_packages
+            )
+            # too large shards always run, their jobs are still skipped one by one
+            if len(in_scope) < MAX_EXPRESSION_LENGTH:
+                condition += f" && ({in_scope})"
+            self.add_job(
+                Job(
+                    f"shard-{shard}",
+                    needs=needs,
+                    condition="${{ " + condition + " }}",
+                    uses=(
+                        f"{wf_config['repo']}/.github/workflows/{wf.file_name}"
+                        f"@{downstream_ci_ref}"
+                    ),
+                    with_inputs=with_inputs,
+                    secrets="inherit",
+                )
+            )
+            workflows.append(wf)
+        return workflows
+
+    def reduce_needs(self):
+        """
+        Replace needs of every job by their transitive reduction, i.e. drop needs
+        which are already needed by another need. Jobs still wait for all of them.
+        setup is always kept, jobs only see outputs of the jobs they directly need.
+        The `needs.*.result` condition of package jobs is unaffected: setup
+        succeeded whenever any other need did.
+        """
+        closures: dict[str, set[str]] = {}
+
+        def closure(name: str) -> set[str]:
+            if name not in closures:
+                needs = self.jobs[name].needs or []
+                needs = [needs] if isinstance(needs, str) else needs
+                closures[name] = set(needs).union(*(closure(n) for n in needs))
+            return closures[name]
+
+        for name, job in self.jobs.items():
+            if not isinstance(job.needs, list):
+                continue
+            job.needs = [
+                need
+                for need in job.needs
+                if need == "setup"
+                or not any(need in closure(other) for other in job.needs)
+            ]
+
+    def analyse_jobs(
+        self, durations: dict, platforms: list[str]
+    ) -> critical_path.CriticalPath:
+        """Critical path of the jobs, weighted with durations from a history."""
+        needs = {
+            name: [job.needs] if isinstance(job.needs, str) else job.needs or []
+            for name, job in self.jobs.items()
+        }
+        job_durations = {}
+        for name, job in self.jobs.items():
+            job_platforms = platforms
+            if job.id:
+                # platform-major, the job of a package on a single matrix entry
+                job_platforms = [
+                    p
+                    for p in self.package_platforms[job.name]
+                    if platform_job_id(job.name, p) == name
+                ]
+            job_durations[name] = critical_path.job_duration(
+                durations, job.name, job_platforms
+            )
+        return critical_path.analyse(needs, job_durations)
+
+    def static_platforms(self, dep_tree: dict, wf_config: dict, package: str):
+        """
+        Matrix entries a package builds on, as the setup script selects them, before
+        skip_matrix_jobs is applied.
+        """
+        return package_entries(
+            wf_config["matrix"]["name"],
+            wf_config.get("optional_matrix", {}).get("name", []),
+            tree_get_package_var("optional_matrix", dep_tree, package, self.name) or [],
+            tree_get_package_var("skip", dep_tree, package, self.setup_wf_name) or [],
+            (
+                wf_config.get("python_jobs")
+                if dep_tree[package].get("type", "cmake") == "python"
+                else None
+            ),
+        )
+
+    def generate_platform_groups(self, dep_tree: dict, wf_config: dict):
+        """
+        Group packages by the matrix entries they build on. Packages of a group share
+        the include list of their matrix, only set once in the setup job outputs.
+        """
+        groups: dict[tuple[str, ...], str] = {}
+        self.platform_groups = {}
+        for package in dep_tree:
+            if not is_input(package, dep_tree, self.name, self.private):
+                continue
+            names = self.static_platforms(dep_tree, wf_config, package)
+            self.platform_groups[package] = groups.setdefault(
+                tuple(names), str(len(groups))
+            )
 
     def generate_setup_job(
         self, dep_tree: dict, wf_config: dict, downstream_ci_ref: str
@@ -533,32 +998,71 @@ class Workflow:
         deps = [
             dep for dep in dep_tree if is_input(dep, dep_tree, self.name, self.private)
         ]
+        if wf_config.get("platform_major", False):
+            self.package_platforms = {
+                dep: self.static_platforms(dep_tree, wf_config, dep) for dep in deps
+            }
         for dep in deps:
             outputs[dep] = "${{ " + f"steps.prepare-inputs.outputs.{dep}" + " }}"
-            outputs[f"{dep}_matrix"] = "${{ " + f"steps.setup.outputs.{dep}" + " }}"
+            outputs[f"{dep}_dep_tree"] = (
+                "${{ " + f"steps.setup.outputs.{dep}_dep_tree" + " }}"
+            )
+            if not self.package_platforms:
+                outputs[f"{dep}_matrix"] = "${{ " + f"steps.setup.outputs.{dep}" + " }}"
+                continue
+            for platform in self.package_platforms[dep]:
+                output = f"{dep}_{platform_slug(platform)}"
+                outputs[f"{output}_matrix"] = (
+                    "${{ " + f"steps.setup.outputs.{output}" + " }}"
+                )
 
         if self.wf_type == "build-package":
-            outputs["dep_tree"] = "${{ steps.setup.outputs.build_package_dep_tree }}"
             outputs["trigger_repo"] = "${{ steps.setup.outputs.trigger_repo }}"
             outputs["trigger_pkgs"] = "${{ steps.setup.outputs.trigger_pkgs }}"
             outputs["py_codecov_platform"] = (
                 "${{ steps.setup.outputs.py_codecov_platform }}"
             )
-        elif self.wf_type == "build-package-hpc":
-            outputs["dep_tree"] = (
-                "${{ steps.setup.outputs.build_package_hpc_dep_tree }}"
-            )
         outputs["use_master"] = "${{ steps.setup.outputs.use_master }}"
         outputs["ci_group_pkgs"] = "${{ steps.setup.outputs.ci_group_pkgs }}"
+        if self.build_keys:
+            outputs["build_keys"] = "${{ steps.setup.outputs.build_keys }}"
+        if wf_config.get("resolve_refs", False):
+            outputs["resolved_refs"] = "${{ steps.setup.outputs.resolved_refs }}"
+        if wf_config.get("compact_matrix", False):
+            self.generate_platform_groups(dep_tree, wf_config)
+            for group in dict.fromkeys(self.platform_groups.values()):
+                outputs[f"platforms_{group}"] = (
+                    "${{ " + f"steps.setup.outputs.platforms_{group}" + " }}"
+                )
         self.inputs.update(
             {
                 "skip_matrix_jobs": {
                     "description": "List of matrix jobs to be skipped.",
                     "required": False,
                     "type": "string",
-                }
+                },
+                "affected_only": {
+                    "description": (
+                        "Whether to only run packages affected by the change, "
+                        "i.e. the triggering packages and their dependents."
+                    ),
+                    "required": False,
+                    "type": "boolean",
+                },
             }
         )
+        if wf_config.get("profiles"):
+            self.inputs["profile"] = {
+                "description": (
+                    "Matrix profile, one of: full, "
+                    + ", ".join(p for p in wf_config["profiles"] if p != "full")
+                    + ". Default: full when triggered from a master branch, "
+                    + wf_config.get("default_profile", "full")
+                    + " otherwise."
+                ),
+                "required": False,
+                "type": "string",
+            }
         steps = []
         if self.private:
             steps.append(
@@ -585,6 +1089,18 @@ class Workflow:
                 },
             }
         )
+        steps.append(
+            {
+                "name": "Restore ci-config cache",
+                "uses": "actions/cache@v4",
+                "with": {
+                    "path": CONFIG_CACHE_DIR,
+                    "key": f"{self.name}-ci-config-"
+                    + "${{ github.run_id }}-${{ github.run_attempt }}",
+                    "restore-keys": f"{self.name}-ci-config-",
+                },
+            }
+        )
         setup_config = {}
         default_config_path = (
             ".github/ci-config.yml"
@@ -617,41 +1133,48 @@ class Workflow:
                         "optional_matrix", dep_tree, dep, self.name
                     ),
                 }
-
-        match self.name:
-            case "private-downstream-ci":
-                wf_name = "downstream-ci"
-            case "private-downstream-ci-hpc":
-                wf_name = "downstream-ci-hpc"
-            case _:
-                wf_name = self.name
+                if self.platform_groups:
+                    setup_config[f"{dep}:{dep_repo}"]["platform_group"] = (
+                        self.platform_groups[dep]
+                    )
 
         s = {
             "name": "Run setup script",
             "id": "setup",
             "env": {
                 "TOKEN": "${{ secrets.GH_REPO_READ_TOKEN }}",
-                "CONFIG": yaml.dump(
+                "CONFIG": yaml_io.dump(
                     setup_config,
+                    block_strings=True,
                     indent=2,
                     default_flow_style=False,
                     sort_keys=False,
                 ),
-                "PYTHON_VERSIONS": yaml.dump(
-                    wf_config["python_versions"], indent=2, default_flow_style=False
+                "PYTHON_VERSIONS": yaml_io.dump(
+                    wf_config["python_versions"],
+                    block_strings=True,
+                    indent=2,
+                    default_flow_style=False,
                 )
                 + "\n",
-                "PYTHON_JOBS": yaml.dump(
+                "PYTHON_JOBS": yaml_io.dump(
                     wf_config.get("python_jobs", []),
+                    block_strings=True,
                     indent=2,
                     default_flow_style=False,
                 )
                 + "\n",
-                "MATRIX": yaml.dump(wf_config["matrix"], indent=2),
-                "OPTIONAL_MATRIX": yaml.dump(
-                    wf_config["optional_matrix"], indent=2, default_flow_style=False
+                "MATRIX": yaml_io.dump(
+                    wf_config["matrix"], block_strings=True, indent=2
                 ),
-                "WORKFLOW_NAME": wf_name,
+                "OPTIONAL_MATRIX": yaml_io.dump(
+                    wf_config["optional_matrix"],
+                    block_strings=True,
+                    indent=2,
+                    default_flow_style=False,
+                ),
+                "WORKFLOW_NAME": self.setup_wf_name,
+                "CONFIG_CACHE_DIR": CONFIG_CACHE_DIR,
                 "DOWNSTREAM_CI_GROUP": "${{ inputs.ci_group }}",
             },
             "run": "python setup_downstream_ci.py",
@@ -665,10 +1188,235 @@ class Workflow:
             if self.private
             else "${{ inputs.skip_matrix_jobs }}"
         )
+        s["env"]["AFFECTED_ONLY"] = (
+            (
+                "${{ inputs.affected_only || github.event.client_payload.inputs."
+                "affected_only }}"
+            )
+            if self.private
+            else "${{ inputs.affected_only }}"
+        )
+        if self.build_keys:
+            s["env"]["BUILD_KEYS"] = "true"
+        if wf_config.get("resolve_refs", False):
+            s["env"]["RESOLVE_REFS"] = "true"
+        if wf_config.get("runner_capacity"):
+            s["env"]["RUNNER_CAPACITY"] = yaml_io.dump(
+                wf_config["runner_capacity"], default_flow_style=False
+            )
+            if wf_config.get("balance_matrix"):
+                s["env"]["BALANCE_MATRIX"] = yaml_io.dump(
+                    wf_config["balance_matrix"], default_flow_style=False
+                )
+        if wf_config.get("profiles"):
+            s["env"]["PROFILES"] = yaml_io.dump(
+                wf_config["profiles"], default_flow_style=False
+            )
+            s["env"]["PROFILE"] = (
+                "${{ inputs.profile || github.event.client_payload.inputs.profile }}"
+                if self.private
+                else "${{ inputs.profile }}"
+            )
+            if wf_config.get("default_profile"):
+                s["env"]["DEFAULT_PROFILE"] = wf_config["default_profile"]
+        if wf_config.get("covering_strength"):
+            s["env"]["COVERING_STRENGTH"] = str(wf_config["covering_strength"])
+        if self.package_platforms:
+            s["env"]["PLATFORM_MAJOR"] = "true"
+        s["env"]["TIMINGS_FILE"] = SETUP_TIMINGS_FILE
         steps.append(s)
+        steps.append(
+            {
+                "name": "Upload setup timings",
+                "if": "${{ !cancelled() }}",
+                "uses": "actions/upload-artifact@v4",
+                "with": {
+                    "name": f"setup-timings-{self.name}",
+                    "path": SETUP_TIMINGS_FILE,
+                    "if-no-files-found": "ignore",
+                    "overwrite": True,
+                },
+            }
+        )
         self.add_job(Job("setup", steps=steps, outputs=outputs))
 
 
+def partition_packages(
+    packages: list[str],
+    graph: DependencyGraph,
+    strategy: Literal["components", "ci-groups"],
+    ci_groups: dict = None,
+) -> dict[str, list[str]]:
+    """
+    Split packages into shards, either weakly connected components of the dependency
+    graph, named after their first package, or groups of ci-groups.yml. Packages in
+    no group go with the first group depending on them, or else to shard `other`.
+    Shards depending on each other are merged.
+    Shards and their packages are in topological order.
+    """
+    in_wf = set(packages)
+    shard_of: dict[str, str] = {}
+    if strategy == "components":
+        # union-find, roots are the first package of a component
+        parent = {package: package for package in packages}
+
+        def find(package: str) -> str:
+            while parent[package] != package:
+                parent[package] = parent[parent[package]]
+                package = parent[package]
+            return package
+
+        order = [pkg for pkg in graph.topological_order if pkg in in_wf]
+        for package in order:
+            for dep in graph.deps(package):
+                if dep in in_wf:
+                    a, b = find(package), find(dep)
+                    if a != b:
+                        first, second = sorted((a, b), key=order.index)
+                        parent[second] = first
+        shard_of = {package: find(package) for package in packages}
+    elif strategy == "ci-groups":
+        for group, members in (ci_groups or {}).items():
+            for package in members or []:  # magic groups have no members
+                if package in in_wf:
+                    shard_of.setdefault(package, group)
+        # dependencies go with the first group needing them, groups don't wait on other
+        for package, group in list(shard_of.items()):
+            for dep in graph.deps(package):
+                if dep in in_wf:
+                    shard_of.setdefault(dep, group)
+        for package in packages:
+            shard_of.setdefault(package, "other")
+    else:
+        sys.exit(f"::error::Unknown shard strategy {strategy}")
+
+    while True:
+        shard_tree: dict[str, dict] = {
+            shard: {"deps": []} for shard in shard_of.values()
+        }
+        for package in packages:
+            shard_deps = shard_tree[shard_of[package]]["deps"]
+            for dep in graph.deps(package):
+                if dep in shard_of and shard_of[dep] != shard_of[package]:
+                    shard_deps.append(shard_of[dep])
+        try:
+            shard_graph = DependencyGraph(shard_tree, None)
+            break
+        except DependencyCycleError as e:
+            merged = set(e.path)
+            for package, shard in shard_of.items():
+                if shard in merged:
+                    shard_of[package] = e.path[0]
+
+    shards = {
+        re.sub(r"[^\w-]", "-", shard): [] for shard in shard_graph.topological_order
+    }
+    for package in graph.topological_order:
+        if package in shard_of:
+            shards[re.sub(r"[^\w-]", "-", shard_of[package])].append(package)
+    return shards
+
+
+def platform_job_id(package: str, platform: str) -> str:
+    """Id of the job of a package on a matrix entry, in platform-major workflows."""
+    return f"{package}--{platform_slug(platform)}"
+
+
+def workflow_platforms(wf_config: dict) -> list[str]:
+    """Names of all matrix entries of a workflow, including optional ones."""
+    return wf_config["matrix"]["name"] + [
+        d["name"] for d in wf_config.get("optional_matrix", {}).get("include", [])
+    ]
+
+
+def workflow_fingerprint(
+    name: str,
+    config: dict,
+    dep_tree: dict,
+    ref: str,
+    ci_groups: dict | None = None,
+) -> str:
+    """
+    Hash of all inputs of a generated workflow: its config section, the dep tree
+    without sections specific to other workflows, the ref, ci groups if used for
+    sharding and the generator itself.
+    """
+    other_wfs = set(config) - {name}
+    wf_dep_tree = {
+        package: {k: v for k, v in (conf or {}).items() if k not in other_wfs}
+        for package, conf in dep_tree.items()
+    }
+    h = hashlib.sha256()
+    for path in GENERATOR_SOURCES:
+        h.update(Path(path).read_bytes())
+    h.update(
+        json.dumps(
+            [name, ref, config[name], wf_dep_tree, ci_groups],
+            default=str,
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+def read_fingerprint(path: Path) -> str | None:
+    """Fingerprint recorded in the header of a previously generated workflow."""
+    try:
+        with open(path, "r") as f:
+            for _, line in zip(range(10), f):
+                if line.startswith(FINGERPRINT_PREFIX):
+                    return line.removeprefix(FINGERPRINT_PREFIX).strip()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def shard_files(output: Path, name: str) -> set[Path]:
+    """Previously generated shard workflows of a workflow, see generate_shards."""
+    shard_name = re.compile(rf"^name: {re.escape(name)} \(.*\)$", re.MULTILINE)
+    return {
+        path
+        for path in Path(output).glob(f"{name}-*.yml")
+        if shard_name.search(path.read_text())
+    }
+
+
+def is_up_to_date(output: Path, name: str, file_name: str, fingerprint: str) -> bool:
+    """
+    Whether a workflow and the shards it calls were generated from the same inputs,
+    without any other shards of the workflow left over.
+    """
+    path = Path(output, file_name)
+    if read_fingerprint(path) != fingerprint:
+        return False
+    called = {
+        Path(output, file_name)
+        for file_name in re.findall(
+            r"/\.github/workflows/([\w.-]+\.yml)@", path.read_text()
+        )
+    }
+    return called == shard_files(output, name) and all(
+        read_fingerprint(shard) == fingerprint for shard in called
+    )
+
+
+def render_workflow(wf: Workflow, fingerprint: str) -> str:
+    return (
+        f"{'#\n'*3}# This is a file generated by generate-workflows.py - DO NOT EDIT!!\n"
+        f"{FINGERPRINT_PREFIX}{fingerprint}\n{'#\n'*3}"
+    ) + yaml_io.dump(
+        wf,
+        block_strings=True,
+        indent=2,
+        sort_keys=False,
+        default_flow_style=False,
+        width=float("inf"),
+    )
+
+
+yaml_io.add_state_representer(Job)
+yaml_io.add_state_representer(Workflow)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", help="Path to configuration file", required=True)
@@ -686,22 +1434,109 @@ def main():
     parser.add_argument(
         "--ref", help="Downstream-ci repo ref", required=False, default="main"
     )
+    parser.add_argument(
+        "--force",
+        help="Regenerate workflows even if their inputs did not change.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--print", help="Print generated workflows to stdout.", action="store_true"
+    )
+    parser.add_argument(
+        "--durations",
+        help=(
+            "Path to job durations history file or job_history.py database. The "
+            "predicted makespan, critical path and the jobs with the least slack "
+            "are printed, also for workflows which are up to date."
+        ),
+    )
+    parser.add_argument(
+        "--ci-groups",
+        help=(
+            "Path to ci groups file, used by workflows sharded by ci groups. "
+            "Defaults to ci-groups.yml next to the configuration file."
+        ),
+    )
+    parser.add_argument(
+        "--output-name",
+        help=(
+            "File name of a generated workflow, as WORKFLOW=FILE, e.g. "
+            "private-downstream-ci=downstream-ci.yml. Shards keep their names."
+        ),
+        action="append",
+        default=[],
+    )
     parser.add_argument("workflows", nargs="*")
     args = parser.parse_args()
 
+    output_names = {}
+    for output_name in args.output_name:
+        name, sep, file_name = output_name.partition("=")
+        if not sep or not file_name.endswith(".yml"):
+            sys.exit(f"::error::invalid --output-name {output_name}")
+        output_names[name] = file_name
+
     with open(args.config, "r") as f:
-        config: dict = yaml.safe_load(f)
+        config: dict = yaml_io.load(f)
 
     with open(args.dep_tree, "r") as f:
-        dep_tree: dict = yaml.safe_load(f)
+        dep_tree: dict = yaml_io.load(f)
+
+    durations = None
+    if args.durations:
+        durations = critical_path.load_durations(args.durations)
+
+    ci_groups = None
+    if any(
+        (wf_config or {}).get("shard") == "ci-groups" for wf_config in config.values()
+    ):
+        with open(args.ci_groups or Path(args.config).parent / "ci-groups.yml") as f:
+            ci_groups = yaml_io.load(f)
 
     for name in config.keys():
         if args.workflows and name not in args.workflows:
             continue
+        wf_ci_groups = ci_groups if config[name].get("shard") == "ci-groups" else None
+        fingerprint = workflow_fingerprint(
+            name, config, dep_tree, args.ref, wf_ci_groups
+        )
+        file_name = output_names.get(name, f"{name}.yml")
+        if (
+            not args.force
+            # the analysis is printed even if the workflow is up to date
+            and durations is None
+            and is_up_to_date(args.output, name, file_name, fingerprint)
+        ):
+            print(f"{name}: up to date")
+            continue
+        try:
+            get_dep_graph(dep_tree, name)
+        except DependencyCycleError as e:
+            sys.exit(f"::error::{e}")
+        if config[name].get("platform_major", False):
+            for option in ("shard", "compact_matrix"):
+                if config[name].get(option):
+                    sys.exit(
+                        f"::error::{name}: platform_major can't be combined with "
+                        f"{option}"
+                    )
+            slugs = [platform_slug(p) for p in workflow_platforms(config[name])]
+            if len(set(slugs)) != len(slugs):
+                sys.exit(f"::error::{name}: matrix entry names collide in job ids")
+        if config[name].get("compact_matrix") and any(
+            profile and profile.get("platforms")
+            for profile in config[name].get("profiles", {}).values()
+        ):
+            sys.exit(
+                f"::error::{name}: profiles limiting platforms can't be combined "
+                "with compact_matrix"
+            )
         wf = Workflow(
             name=name,
             wf_type=config[name]["type"],
             private=config[name].get("private", False),
+            build_keys=config[name].get("build_keys", False),
+            platform_isolation=config[name].get("platform_isolation", False),
         )
         wf.generate_inputs(dep_tree, config[name])
         wf.generate_setup_job(dep_tree, config[name], args.ref)
@@ -709,21 +1544,33 @@ def main():
             wf.add_python_qa_job()
         if config[name].get("clang_format", False):
             wf.add_clang_format_job()
-        wf.generate_package_jobs(dep_tree)
-        print(yaml.dump(wf, indent=2, sort_keys=False, default_flow_style=False))
-        print("=" * 10)
-        with open(PurePath(args.output, name + ".yml"), "w") as f:
-            f.write(
-                f"{'#\n'*3}# This is a file generated by generate-workflows.py - DO NOT EDIT!!\n{'#\n'*3}"
-            )
-            yaml.dump(
-                wf,
-                stream=f,
-                indent=2,
-                sort_keys=False,
-                default_flow_style=False,
-                width=float("inf"),
-            )
+        shards = []
+        if config[name].get("shard"):
+            shards = wf.generate_shards(dep_tree, config[name], wf_ci_groups, args.ref)
+        else:
+            wf.generate_package_jobs(dep_tree)
+        for w in [wf, *shards]:
+            w_file_name = w.file_name if w.shard else file_name
+            w_name = Path(w_file_name).stem
+            if config[name].get("reduce_needs", False):
+                w.reduce_needs()
+            if durations is not None:
+                result = w.analyse_jobs(durations, workflow_platforms(config[name]))
+                print(critical_path.format_report(w_name, result))
+            content = render_workflow(w, fingerprint)
+            if args.print:
+                print(content)
+                print("=" * 10)
+            w_path = Path(args.output, w_file_name)
+            if w_path.exists() and w_path.read_text() == content:
+                print(f"{w_name}: unchanged")
+                continue
+            w_path.write_text(content)
+            print(f"{w_name}: written to {w_path}")
+        written = {Path(args.output, w.file_name) for w in shards}
+        for path in sorted(shard_files(args.output, name) - written):
+            path.unlink()
+            print(f"{path.stem}: removed, no longer a shard of {name}")
 
 
 if __name__ == "__main__":
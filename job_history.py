@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+History of downstream CI job durations, kept in a local sqlite database.
+
+Jobs are ingested from exported GitHub Actions job listings, e.g.
+    gh api --paginate repos/<owner>/<repo>/actions/runs/<run_id>/jobs > jobs.json
+Files may contain several concatenated json documents, as paginated exports do, each
+either a listing with `jobs`, a single job or a list of those, as exported with
+--slurp. Listings of runs with `workflow_runs` name the workflow of jobs which lack
+`workflow_name`. Re-ingesting a job replaces it.
+
+Job names are mapped back to packages and matrix entries: a matrix job named
+`[shard-x / ]eckit (gnu@rocky-8.6, ...)` is package eckit on platform gnu@rocky-8.6,
+the first of its matrix values which names a matrix entry in config.yml. Other jobs,
+like setup, are kept under their name without a platform.
+
+Usage:
+    python job_history.py ingest jobs/*.json
+    python job_history.py report --workflow downstream-ci --package eckit
+    python generate-workflows.py --durations job-history.db ...
+
+See also critical_path.load_durations, which reads durations from the database.
+"""
+
+import argparse
+import datetime
+import json
+import sqlite3
+from dataclasses import dataclass
+
+import yaml_io
+
+DEFAULT_DATABASE = "job-history.db"
+FAILED = ("failure", "timed_out")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER,
+    run_attempt INTEGER,
+    workflow TEXT,
+    package TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    conclusion TEXT,
+    created INTEGER,
+    started INTEGER,
+    completed INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_package ON jobs (package, platform);
+"""
+
+
+@dataclass
+class JobStats:
+    workflow: str
+    package: str
+    platform: str
+    runs: int
+    duration_p50: float | None
+    duration_p95: float | None
+    queue_p50: float | None
+    queue_p95: float | None
+    failure_rate: float
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """Nearest-rank percentile of sorted values, None if there are none."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))  # ceil
+    return values[int(rank) - 1]
+
+
+def _timestamp(value: str | None) -> int | None:
+    if not value:
+        return None
+    # github timestamps end in Z, which fromisoformat only accepts from python 3.11
+    return int(
+        datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    )
+
+
+def parse_job_name(name: str, platforms: set[str]) -> tuple[str, str]:
+    """Package and platform of a job name, see the module docstring."""
+    name = name.rsplit(" / ", 1)[-1]
+    package, _, values = name.partition(" (")
+    platform = next((v for v in values.rstrip(")").split(", ") if v in platforms), "")
+    return package, platform
+
+
+def read_exports(paths: list[str]) -> tuple[list[dict], dict[int, str]]:
+    """Jobs in exported files, and workflow names of runs by run id."""
+    jobs = []
+    runs = {}
+    decoder = json.JSONDecoder()
+    for path in paths:
+        with open(path, "r") as f:
+            text = f.read()
+        pos = 0
+        while pos < len(text):
+            if text[pos].isspace():
+                pos += 1
+                continue
+            doc, pos = decoder.raw_decode(text, pos)
+            docs = [doc]
+            while docs:
+                doc = docs.pop()
+                if isinstance(doc, list):
+                    docs.extend(reversed(doc))
+                elif "jobs" in doc:
+                    jobs.extend(doc["jobs"])
+                elif "workflow_runs" in doc:
+                    runs.update({r["id"]: r["name"] for r in doc["workflow_runs"]})
+                elif "run_id" in doc:
+                    jobs.append(doc)
+    return jobs, runs
+
+
+def config_platforms(config: dict) -> set[str]:
+    """Names of all matrix entries of all workflows in config.yml."""
+    return {
+        name
+        for wf_config in config.values()
+        for name in wf_config.get("matrix", {}).get("name", [])
+        + [d["name"] for d in wf_config.get("optional_matrix", {}).get("include", [])]
+    }
+
+
+class JobHistory:
+    def __init__(self, path: str = DEFAULT_DATABASE):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(
+        self,
+        jobs: list[dict],
+        platforms: set[str],
+        runs: dict[int, str] | None = None,
+    ) -> int:
+        """Store completed jobs, returns how many were stored."""
+        runs = runs or {}
+        rows = []
+        for job in jobs:
+            if job.get("status") != "completed":
+                continue
+            package, platform = parse_job_name(job["name"], platforms)
+            rows.append(
+                (
+                    job["id"],
+                    job.get("run_id"),
+                    job.get("run_attempt", 1),
+                    job.get("workflow_name") or runs.get(job.get("run_id")),
+                    package,
+                    platform,
+                    job.get("conclusion"),
+                    _timestamp(job.get("created_at")),
+                    _timestamp(job.get("started_at")),
+                    _timestamp(job.get("completed_at")),
+                )
+            )
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def _select(self, columns: str, conditions: list[tuple[str, object]]):
+        where = ["conclusion NOT IN ('skipped', 'cancelled')"]
+        params = []
+        for condition, value in conditions:
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        return self.db.execute(
+            f"SELECT {columns} FROM jobs WHERE {' AND '.join(where)}", params
+        )
+
+    def stats(
+        self,
+        workflow: str | None = None,
+        package: str | None = None,
+        since: int | None = None,
+    ) -> list[JobStats]:
+        """
+        Statistics per workflow, package and platform. Durations are those of
+        successful jobs, queue times of all jobs which started, the failure rate is
+        the share of failed or timed out jobs among the ones which didn't get
+        skipped or cancelled. `since` is a unix timestamp.
+        """
+        rows = self._select(
+            "IFNULL(workflow, ''), package, platform, conclusion, "
+            "completed - started, started - created",
+            [
+                ("workflow = ?", workflow),
+                ("package = ?", package),
+                ("completed >= ?", since),
+            ],
+        )
+        groups: dict[tuple, list] = {}
+        for *key, conclusion, duration, queue in rows:
+            groups.setdefault(tuple(key), []).append((conclusion, duration, queue))
+
+        result = []
+        for key, jobs in sorted(groups.items()):
+            durations = sorted(
+                d for c, d, _ in jobs if c == "success" and d is not None
+            )
+            queues = sorted(q for _, _, q in jobs if q is not None)
+            failed = sum(c in FAILED for c, _, _ in jobs)
+            result.append(
+                JobStats(
+                    *key,
+                    runs=len(jobs),
+                    duration_p50=percentile(durations, 50),
+                    duration_p95=percentile(durations, 95),
+                    queue_p50=percentile(queues, 50),
+                    queue_p95=percentile(queues, 95),
+                    failure_rate=failed / len(jobs),
+                )
+            )
+        return result
+
+    def durations(self, p: float = 50, workflow: str | None = None) -> dict:
+        """
+        Durations in the format of critical_path.load_durations: the given
+        percentile of successful jobs of every package and platform, over all
+        workflows unless one is given. Jobs without a platform, like setup, get a
+        single duration.
+        """
+        rows = self._select(
+            "package, platform, completed - started",
+            [("conclusion = ?", "success"), ("workflow = ?", workflow)],
+        )
+        groups: dict[tuple[str, str], list[int]] = {}
+        for package, platform, duration in rows:
+            if duration is not None:
+                groups.setdefault((package, platform), []).append(duration)
+        durations = {}
+        for (package, platform), values in sorted(groups.items()):
+            value = percentile(sorted(values), p)
+            if platform:
+                durations.setdefault(package, {})[platform] = value
+            else:
+                durations[package] = value
+        return durations
+
+
+def format_seconds(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds / 60:.1f}m"
+
+
+def format_stats(stats: list[JobStats]) -> str:
+    header = ("workflow", "package", "platform", "runs", "p50", "p95", "queue p50")
+    rows = [header + ("queue p95", "failures")]
+    for s in stats:
+        rows.append(
+            (
+                s.workflow,
+                s.package,
+                s.platform or "-",
+                str(s.runs),
+                format_seconds(s.duration_p50),
+                format_seconds(s.duration_p95),
+                format_seconds(s.queue_p50),
+                format_seconds(s.queue_p95),
+                f"{s.failure_rate:.0%}",
+            )
+        )
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest", help="Ingest exported job listings.")
+    ingest.add_argument("files", nargs="+")
+    ingest.add_argument("--config", default="config.yml")
+    report = subparsers.add_parser("report", help="Print statistics.")
+    report.add_argument("--workflow")
+    report.add_argument("--package")
+    report.add_argument("--days", type=int, help="Only jobs of the last days.")
+    args = parser.parse_args()
+
+    history = JobHistory(args.database)
+    if args.command == "ingest":
+        with open(args.config, "r") as f:
+            platforms = config_platforms(yaml_io.load(f))
+        jobs, runs = read_exports(args.files)
+        print(f"Ingested {history.ingest(jobs, platforms, runs)} jobs")
+    else:
+        since = None
+        if args.days is not None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            since = int((now - datetime.timedelta(days=args.days)).timestamp())
+        print(format_stats(history.stats(args.workflow, args.package, since)))
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Selection of the matrix entries of packages, shared by generate-workflows.py and
+setup_downstream_ci.py. The generator names jobs and setup outputs after the entries
+setup builds packages on, both have to select them the same way.
+"""
+
+import re
+
+
+def platform_slug(name: str) -> str:
+    """Matrix entry name usable in job ids and outputs, e.g. gnu-rocky-8-6."""
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+
+def package_entries(
+    names: list[str],
+    optional_names: list[str],
+    opt_in: list[str],
+    skip: list[str],
+    python_jobs: list[str] | None = None,
+) -> list[str]:
+    """
+    Matrix entries a package builds on: the entries of the workflow matrix and the
+    optional ones the package opted in to, without the ones it skips. Python packages
+    pass the workflow's python_jobs, only those are kept.
+    """
+    entries = [
+        name
+        for name in names + [name for name in optional_names if name in opt_in]
+        if name not in skip
+    ]
+    if python_jobs:
+        entries = [name for name in entries if name in python_jobs]
+    return entries
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Local stand-in for raw.githubusercontent.com, serving package configs from a mirror
+directory laid out as <owner>/<repo>/<ref>/<path>.
+
+Responses carry an ETag and honour If-None-Match like the real server. Like the
+github API, /repos/<owner>/<repo>/commits/<ref> returns the commit SHA of a ref,
+see setup_downstream_ci.mirror_commit, and POST /graphql answers the batched
+queries of setup_downstream_ci.resolve_query. Latency and errors can be injected to
+reproduce slow or flaky fetches. Errors are deterministic: the same paths fail on
+every run.
+
+Usage:
+    python mirror_server.py path/to/mirror --port 8000 --latency 0.05 --error-rate 0.1
+    CONFIG_BASE_URL=http://127.0.0.1:8000 python setup_downstream_ci.py
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from setup_downstream_ci import mirror_commit
+
+_STRING = r'"(?:[^"\\]|\\.)*"'
+GRAPHQL_REPOSITORY = re.compile(
+    rf"(\w+): repository\(owner: ({_STRING}), name: ({_STRING})\)"
+    rf" \{{ object\(expression: ({_STRING})\)"
+)
+
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like raw.githubusercontent.com
+
+    def __init__(self, *args, latency=0.0, error_rate=0.0, error_status=500, **kwargs):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        super().__init__(*args, **kwargs)
+
+    def is_error(self) -> bool:
+        return zlib.crc32(self.path.encode()) % 1000 < self.error_rate * 1000
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.is_error():
+            self.send_error(self.error_status)
+            return
+        if self.path.startswith("/repos/"):
+            self.send_commit()
+            return
+        path = self.translate_path(self.path)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        if self.path != "/graphql" or self.is_error():
+            self.send_error(404 if self.path != "/graphql" else self.error_status)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            query = json.loads(body)["query"]
+        except (ValueError, KeyError):
+            self.send_error(400)
+            return
+        data = {}
+        for alias, owner, repo, ref in GRAPHQL_REPOSITORY.findall(query):
+            owner, repo, ref = (json.loads(s) for s in (owner, repo, ref))
+            directory = os.path.join(
+                self.directory, owner, repo, ref.removesuffix("^{commit}")
+            )
+            data[alias] = (
+                {"object": {"oid": mirror_commit(directory)}}
+                if os.path.isdir(directory)
+                else None
+            )
+        content = json.dumps({"data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_commit(self):
+        parts = self.path.split("?")[0].split("/")
+        if len(parts) != 6 or parts[4] != "commits":
+            self.send_error(404)
+            return
+        _, _, owner, repo, _, ref = parts
+        directory = os.path.join(self.directory, owner, repo, ref)
+        if not os.path.isdir(directory):
+            self.send_error(422)  # what the API returns for unknown refs
+            return
+        content = mirror_commit(directory).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.github.sha")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MirrorServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections of concurrent fetches, which are
+    # only retried after a second
+    request_queue_size = 128
+
+
+def serve_mirror(
+    directory: str,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+    port: int = 0,
+) -> MirrorServer:
+    """Serve a mirror directory from a background thread, returns the server."""
+    handler = functools.partial(
+        MirrorHandler,
+        directory=str(directory),
+        latency=latency,
+        error_rate=error_rate,
+        error_status=error_status,
+    )
+    server = MirrorServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Mirror laid out as owner/repo/ref/path.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Delay of every response in s."
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Share of paths which fail, always the same ones.",
+    )
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    server = serve_mirror(
+        args.directory, args.latency, args.error_rate, args.error_status, args.port
+    )
+    print(f"Serving {args.directory} at http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Projected load of self-hosted runner pools, and balancing of build matrices across
+them.
+
+config.yml may declare the number of runners behind labels of a workflow:
+    ```
+    runner_capacity:
+      platform-builder-rocky-8.6: 4
+      platform-builder-fedora-37: 2
+    balance_matrix:             Optional, matrix entries which may be dropped
+      - clang@rocky-8.6
+    ```
+Jobs of a matrix entry run on the first of its labels with a declared capacity. Package
+jobs run in waves: a package starts once its dependencies are built, so the wave of a
+package is its depth in the dependency graph of the packages being built. The projected
+queue depth of a label is the number of its jobs in the busiest wave exceeding its
+capacity.
+
+Balancing drops `balance_matrix` entries of overloaded labels from packages off the
+critical path, i.e. not on a longest dependency chain, packages with the most slack
+first, until no wave exceeds the capacity. Triggering packages, packages on the
+critical path and compact matrices are never changed, and no package loses its last
+matrix entry. Dependents still build dropped packages as their dependencies.
+"""
+
+from dataclasses import dataclass
+
+from dependency_graph import DependencyGraph
+
+
+@dataclass
+class LabelLoad:
+    label: str
+    capacity: int
+    jobs: int
+    peak: int  # jobs of the busiest wave
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.peak - self.capacity)
+
+
+@dataclass
+class Waves:
+    """Wave of every package, with the length of the longest chain through it."""
+
+    wave: dict[str, int]
+    chain: dict[str, int]
+
+    @property
+    def longest(self) -> int:
+        return max(self.chain.values(), default=0)
+
+    def slack(self, package: str) -> int:
+        return self.longest - self.chain[package]
+
+
+def get_waves(graph: DependencyGraph, packages: list[str]) -> Waves:
+    selected = set(packages)
+    order = [p for p in graph.topological_order if p in selected]
+    ordered = set(order)
+    order += [p for p in packages if p not in ordered]
+    depth = {}
+    for package in order:
+        deps = [depth[d] for d in graph.deps(package) if d in depth]
+        depth[package] = 1 + max(deps, default=0)
+    height = {p: 1 for p in order}
+    for package in reversed(order):
+        for dep in graph.deps(package):
+            if dep in height:
+                height[dep] = max(height[dep], height[package] + 1)
+    return Waves(
+        {p: depth[p] - 1 for p in order},
+        {p: depth[p] + height[p] - 1 for p in order},
+    )
+
+
+def entry_labels(entries: list[dict], capacity: dict[str, int]) -> dict[str, str]:
+    """Label with a declared capacity of every matrix entry which has one."""
+    labels = {}
+    for entry in entries:
+        label = next((lb for lb in entry.get("labels", []) if lb in capacity), None)
+        if label is not None:
+            labels[entry["name"]] = label
+    return labels
+
+
+def jobs_per_entry(matrix: dict, name: str) -> int:
+    """
+    Jobs of a matrix entry, e.g. one per python version, less the combinations
+    excluded by covering arrays.
+    """
+    count = 1
+    for key, values in matrix.items():
+        if key not in ("name", "include", "exclude") and isinstance(values, list):
+            count *= len(values)
+    return count - sum(d.get("name") == name for d in matrix.get("exclude", []))
+
+
+def _demand(matrices, waves, labels) -> dict[tuple[str, int], int]:
+    demand = {}
+    for package, matrix in matrices.items():
+        if package not in waves.wave:
+            continue
+        for name in matrix["name"]:
+            if name in labels:
+                key = (labels[name], waves.wave[package])
+                demand[key] = demand.get(key, 0) + jobs_per_entry(matrix, name)
+    return demand
+
+
+def project_load(
+    matrices: dict[str, dict],
+    waves: Waves,
+    labels: dict[str, str],
+    capacity: dict[str, int],
+) -> list[LabelLoad]:
+    demand = _demand(matrices, waves, labels)
+    return [
+        LabelLoad(
+            label,
+            capacity[label],
+            sum(n for (lb, _), n in demand.items() if lb == label),
+            max((n for (lb, _), n in demand.items() if lb == label), default=0),
+        )
+        for label in capacity
+    ]
+
+
+def balance(
+    matrices: dict[str, dict],
+    waves: Waves,
+    labels: dict[str, str],
+    capacity: dict[str, int],
+    balance_names: list[str],
+    keep: list[str],
+) -> list[tuple[str, str]]:
+    """
+    Drop entries of overloaded labels from matrices in place, see the module
+    docstring. Returns the dropped (package, entry name) pairs.
+    """
+    demand = _demand(matrices, waves, labels)
+    candidates = sorted(
+        (
+            (-waves.slack(package), package, name)
+            for package, matrix in matrices.items()
+            if package in waves.wave
+            and package not in keep
+            and waves.slack(package) > 0
+            and "include" in matrix
+            for name in matrix["name"]
+            if name in balance_names and name in labels
+        )
+    )
+    dropped = []
+    for _, package, name in candidates:
+        matrix = matrices[package]
+        key = (labels[name], waves.wave[package])
+        if demand[key] <= capacity[key[0]] or len(matrix["name"]) == 1:
+            continue
+        demand[key] -= jobs_per_entry(matrix, name)
+        matrix["name"] = [n for n in matrix["name"] if n != name]
+        matrix["include"] = [d for d in matrix["include"] if d["name"] != name]
+        if "exclude" in matrix:
+            matrix["exclude"] = [d for d in matrix["exclude"] if d["name"] != name]
+        dropped.append((package, name))
+    return dropped
+
+
+def format_load(loads: list[LabelLoad]) -> str:
+    return "\n".join(
+        f"  {load.label}: {load.jobs} jobs, peak {load.peak} per wave, "
+        f"capacity {load.capacity}, projected queue depth {load.queue_depth}"
+        for load in loads
+    )
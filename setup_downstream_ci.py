@@ -16,8 +16,51 @@ Inputs (as environment variables):
                                                 default: "master"
                 develop_branch: branch2         Optional, name of develop-type branch,
                                                 default: "develop"
+                platform_group: "0"             Optional, output a compact matrix
             ```
     SKIP_MATRIX_JOBS: Multiline string, list of matrix job names to be skipped
+    FETCH_WORKERS: Optional, number of configs fetched concurrently, default: 16
+    CONFIG_BASE_URL: Optional, URL configs are fetched from as
+                     <url>/<owner>/<repo>/<ref>/<path>, file:///path/to/mirror reads
+                     them from a local directory, see also mirror_server.py,
+                     default: "https://raw.githubusercontent.com"
+    CONFIG_CACHE_DIR: Optional, directory with cached configs, persisted between runs.
+                      Cached configs are revalidated using their ETag.
+    CONFIG_CACHE_MAX_AGE: Optional, age in seconds under which cached configs are used
+                          without revalidation, default: 0
+    RESOLVE_REFS: Optional, "true" to resolve the ref of every package to a commit
+    BUILD_KEYS: Optional, "true" to resolve refs as with RESOLVE_REFS and output build
+                keys
+    GITHUB_API_URL: Optional, URL of the github API refs are resolved with,
+                    default: "https://api.github.com"
+    TIMINGS_FILE: Optional, file timing spans of the setup phases and of every config
+                  fetch are written to as json, see timing.py. A summary of them is
+                  added to $GITHUB_STEP_SUMMARY when it is set.
+    RUNNER_CAPACITY: Optional, yaml object with the number of runners per label, the
+                     projected queue depth of every label is reported, see
+                     runner_capacity.py
+    BALANCE_MATRIX: Optional, yaml list of matrix entries which may be dropped from
+                    packages off the critical path while their runners are
+                    overloaded, requires RUNNER_CAPACITY
+    COVERING_STRENGTH: Optional, strength of covering arrays matrices of packages
+                       other than triggering ones are reduced to, e.g. 2 to only
+                       build every pair of matrix values, see covering_array.py
+    PROFILES: Optional, yaml object of matrix profiles by name, e.g.
+              ```
+              quick:
+                platforms: 1            Optional, matrix entries of packages other
+                                        than triggering ones, the first ones
+                covering_strength: 2    Optional, overrides COVERING_STRENGTH
+              ```
+              Profile full, today's matrices, needs no declaration.
+    PROFILE: Optional, profile to use, default: full when triggered from a master
+             branch, DEFAULT_PROFILE otherwise
+    DEFAULT_PROFILE: Optional, default: "full"
+    PLATFORM_MAJOR: Optional, "true" to output the matrix of every package as one
+                    matrix per matrix entry, see format_outputs
+    AFFECTED_ONLY: Optional, "true" to only set up packages affected by the change, i.e.
+                   triggering packages and packages with an input, together with
+                   everything which depends on them
     PYTHON_VERSIONS: Yaml list, list of python version to expand the matrix with
     PYTHON_JOBS: Yaml list, list of jobs to be used for python packages
     MATRIX: Yaml object, see
@@ -28,55 +71,135 @@ Outputs:
     Outputs are written to $GITHUB_OUTPUT file.
 
     trigger_repo: name of the triggerring repository without the owner prefix
-    build_package_dep_tree: parsed dependency tree in yaml format for build-package
-    build_package_hpc_dep_tree: parsed dependency tree in yaml format for
-                                build-package-hpc
     <repo>: for each repo in CONFIG input, this will produce an output with name of the
             repository. Contains the build matrix for the specific package. Matrix
             contains variables `owner_repo_ref` (used for repository input to
             build-package(-hpc)) and `config_path` (build config file path).
+            For packages with a `platform_group`, the matrix is compact: members of
+            the matrix object without `include`, `owner_repo_ref` and `config_path`
+            being single valued variables. Workflows complete it with the include
+            list of the group.
+    <repo>_dep_tree: for each package with a matrix, its dependency tree from the
+                     dependency tree of the workflow, i.e. build-package-hpc's for
+                     downstream-ci-hpc and build-package's otherwise, limited to the
+                     package and its dependencies, recursively, as compact json
+    platforms_<group>: include list of the matrices of each platform group
+    resolved_refs: with RESOLVE_REFS or BUILD_KEYS, json object with the commit SHA
+                   of every package, null if its ref couldn't be resolved
+    build_keys: with BUILD_KEYS, json object with keys per package, matrix entry name
+                and "<config>/<python_version>" of its matrix, empty if the package
+                has no such axis. A key hashes the commit of the package, the matrix
+                entry, its HPC modules, the config and python version, and the build
+                keys of its dependencies on the same entry. Unchanged packages built
+                on unchanged dependencies keep their key. Packages whose ref, or a
+                dependency's, couldn't be resolved have no keys.
 """
 
-import copy
+import hashlib
 import json
 import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-import requests
-import yaml
-
-# Load inputs
-ci_config: dict = yaml.safe_load(os.getenv("CONFIG", ""))
-python_versions = yaml.safe_load(os.getenv("PYTHON_VERSIONS", ""))
-python_jobs = yaml.safe_load(os.getenv("PYTHON_JOBS", ""))
-matrix = yaml.safe_load(os.getenv("MATRIX", ""))
-optional_matrix = yaml.safe_load(os.getenv("OPTIONAL_MATRIX", "")) or {}
-skip_jobs = os.getenv("SKIP_MATRIX_JOBS", "").splitlines()
-token = os.getenv("TOKEN", "")
-trigger_ref_name = os.getenv("DISPATCH_REF_NAME") or os.getenv("GITHUB_REF_NAME", "")
-workflow_name = os.getenv("WORKFLOW_NAME", "")
-ci_group = os.getenv("DOWNSTREAM_CI_GROUP", "")
-
-github_repository = os.getenv("DISPATCH_REPOSITORY") or os.getenv(
-    "GITHUB_REPOSITORY", ""
+import yaml_io
+from covering_array import reduce_matrix
+from dependency_graph import get_dep_graph
+from matrix_entries import package_entries, platform_slug
+from runner_capacity import (
+    balance,
+    entry_labels,
+    format_load,
+    get_waves,
+    project_load,
 )
-_, trigger_repo = github_repository.split("/")
-print(f"Triggered from: {trigger_repo}")
-
+from timing import Timings
 
 DEFAULT_MASTER_BRANCH_NAME = "master"
 DEFAULT_DEVELOP_BRANCH_NAME = "develop"
+FETCH_TIMEOUT = 30  # seconds
+# refs resolved per GraphQL query, keeps queries within github's node limits
+RESOLVE_BATCH_SIZE = 100
+# github limits for a single output and all outputs of a workflow run
+OUTPUT_SIZE_LIMIT = 1024 * 1024
+OUTPUTS_TOTAL_LIMIT = 50 * 1024 * 1024
+OUTPUT_SIZE_WARNING = 0.8  # warn above this share of a limit
+
 
-with open("dependency_tree.yml", "r") as f:
-    dep_tree = yaml.safe_load(f)
+@dataclass
+class Settings:
+    """Inputs of the setup script, see the module docstring."""
 
+    ci_config: dict
+    python_versions: list
+    python_jobs: list
+    matrix: dict
+    optional_matrix: dict
+    skip_jobs: list[str] = field(default_factory=list)
+    token: str = ""
+    github_repository: str = ""
+    trigger_ref_name: str = ""
+    workflow_name: str = ""
+    ci_group: str = ""
+    affected_only: bool = False
+    fetch_workers: int = 16
+    config_base_url: str = "https://raw.githubusercontent.com"
+    config_cache_dir: str = ""
+    config_cache_max_age: int = 0
+    resolve_refs: bool = False
+    build_keys: bool = False
+    api_url: str = "https://api.github.com"
+    timings_file: str = ""
+    runner_capacity: dict[str, int] = field(default_factory=dict)
+    balance_matrix: list[str] = field(default_factory=list)
+    covering_strength: int = 0
+    profiles: dict[str, dict] = field(default_factory=dict)
+    profile: str = ""
+    default_profile: str = "full"
+    platform_major: bool = False
+    step_summary: str = ""
 
-trigger_pkgs = [
-    k
-    for k, v in dep_tree.items()
-    if v.get("repo", k) in [github_repository, trigger_repo]
-]
-print(f"Trigger packages: {trigger_pkgs}")
+    @classmethod
+    def from_env(cls, env: dict = os.environ) -> "Settings":
+        return cls(
+            ci_config=yaml_io.load(env.get("CONFIG", "")),
+            python_versions=yaml_io.load(env.get("PYTHON_VERSIONS", "")),
+            python_jobs=yaml_io.load(env.get("PYTHON_JOBS", "")),
+            matrix=yaml_io.load(env.get("MATRIX", "")),
+            optional_matrix=yaml_io.load(env.get("OPTIONAL_MATRIX", "")) or {},
+            skip_jobs=env.get("SKIP_MATRIX_JOBS", "").splitlines(),
+            token=env.get("TOKEN", ""),
+            github_repository=env.get("DISPATCH_REPOSITORY")
+            or env.get("GITHUB_REPOSITORY", ""),
+            trigger_ref_name=env.get("DISPATCH_REF_NAME")
+            or env.get("GITHUB_REF_NAME", ""),
+            workflow_name=env.get("WORKFLOW_NAME", ""),
+            ci_group=env.get("DOWNSTREAM_CI_GROUP", ""),
+            affected_only=env.get("AFFECTED_ONLY", "").lower() == "true",
+            fetch_workers=int(env.get("FETCH_WORKERS") or 16),
+            config_base_url=env.get("CONFIG_BASE_URL")
+            or "https://raw.githubusercontent.com",
+            config_cache_dir=os.path.expanduser(env.get("CONFIG_CACHE_DIR", "")),
+            config_cache_max_age=int(env.get("CONFIG_CACHE_MAX_AGE") or 0),
+            resolve_refs=env.get("RESOLVE_REFS", "").lower() == "true",
+            build_keys=env.get("BUILD_KEYS", "").lower() == "true",
+            api_url=env.get("GITHUB_API_URL") or "https://api.github.com",
+            timings_file=env.get("TIMINGS_FILE", ""),
+            runner_capacity=yaml_io.load(env.get("RUNNER_CAPACITY", "")) or {},
+            balance_matrix=yaml_io.load(env.get("BALANCE_MATRIX", "")) or [],
+            covering_strength=int(env.get("COVERING_STRENGTH") or 0),
+            profiles=yaml_io.load(env.get("PROFILES", "")) or {},
+            profile=env.get("PROFILE", ""),
+            default_profile=env.get("DEFAULT_PROFILE") or "full",
+            platform_major=env.get("PLATFORM_MAJOR", "").lower() == "true",
+            step_summary=env.get("GITHUB_STEP_SUMMARY", ""),
+        )
+
+    @property
+    def trigger_repo(self) -> str:
+        return self.github_repository.split("/")[1]
 
 
 def tree_get_package_var(var_name: str, dep_tree: dict, package: str, wf_name: str):
@@ -90,35 +213,346 @@ def tree_get_package_var(var_name: str, dep_tree: dict, package: str, wf_name: s
     return None
 
 
-# Get build-pacakge(-hpc) config for each repo
-def get_config(owner, repo, pkg_name, ref, path):
-    print(f"Getting config for {pkg_name}:{owner}/{repo}@{ref}")
-    return_obj = {"pkg_name": pkg_name, "matrix": [], "setup_matrix": False}
-    if not path:
-        print(f"Config path not provided for {pkg_name}")
-        return_obj["setup_matrix"] = True
-        return return_obj
+class ConfigCache:
+    """
+    On-disk cache of parsed package configs, one json file per owner/repo/ref/path.
+    Entries store the ETag of the fetched file, so they can be revalidated with
+    `If-None-Match` and reused without downloading and parsing the file again.
+    """
 
-    url = f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}"
-    response = requests.get(url, headers={"Authorization": f"token {token}"})
+    def __init__(self, directory: str, max_age: int):
+        self.directory = directory
+        self.max_age = max_age
+        if directory:
+            os.makedirs(directory, exist_ok=True)
 
-    if response.status_code == 200:
-        content = response.content.decode()
-        config = yaml.safe_load(content)
-        return_obj["matrix"] = config.get("matrix", [])
-        return_obj["setup_matrix"] = True
-        return return_obj
+    def _path(self, key: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
 
-    print(f"::warning::Config for {owner}/{repo}@{ref} not found.")
-    print(response.status_code, response.content)
+    def get(self, key: str) -> dict | None:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("key") == key else None
 
-    if pkg_name in trigger_pkgs:
-        print(
-            f"::error::Config file {path} for triggering package {pkg_name} not found"
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["fetched"] < self.max_age
+
+    def put(self, key: str, etag: str, matrix: list):
+        if not self.directory or not etag:
+            return
+        entry = {"key": key, "etag": etag, "fetched": time.time(), "matrix": matrix}
+        # write to a temporary file first, entries are written from worker threads
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+
+
+@dataclass
+class FetchResult:
+    status: int | None  # None if the request failed
+    content: bytes = b""
+    etag: str | None = None
+    error: str = ""
+
+
+class HTTPBackend:
+    """
+    Fetches files over HTTP, from raw.githubusercontent.com or a stand-in like
+    mirror_server.py. requests is only imported, and the session opened, on the
+    first fetch.
+    """
+
+    def __init__(self, base_url: str, token: str, workers: int, api_url: str):
+        self.base_url = base_url
+        self.token = token
+        self.workers = workers
+        self.api_url = api_url
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+
+            # keeps connections to raw.githubusercontent.com alive between fetches
+            self._session = requests.Session()
+            self._session.headers["Authorization"] = f"token {self.token}"
+            for url in (self.base_url, self.api_url):
+                self._session.mount(
+                    url,
+                    requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.workers
+                    ),
+                )
+        return self._session
+
+    def fetch(self, owner, repo, ref, path, etag=None) -> FetchResult:
+        import requests
+
+        url = f"{self.base_url}/{owner}/{repo}/{ref}/{path}"
+        headers = {"If-None-Match": etag} if etag else {}
+        try:
+            response = self.session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        except requests.RequestException as e:
+            return FetchResult(None, error=repr(e))
+        return FetchResult(
+            response.status_code, response.content, response.headers.get("ETag")
         )
-        sys.exit(1)
 
-    return return_obj
+    def resolve(self, owner, repo, ref) -> FetchResult:
+        """Commit SHA of a ref, in `content`."""
+        import requests
+
+        url = f"{self.api_url}/repos/{owner}/{repo}/commits/{ref}"
+        headers = {"Accept": "application/vnd.github.sha"}
+        try:
+            response = self.session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        except requests.RequestException as e:
+            return FetchResult(None, error=repr(e))
+        return FetchResult(response.status_code, response.content.strip())
+
+    def resolve_batch(
+        self, refs: list[tuple[str, str, str]]
+    ) -> dict[tuple[str, str, str], str | None] | None:
+        """
+        Commit SHAs of (owner, repo, ref) tuples with a single GraphQL query per
+        RESOLVE_BATCH_SIZE refs, None if a query failed.
+        """
+        import requests
+
+        shas = {}
+        for start in range(0, len(refs), RESOLVE_BATCH_SIZE):
+            batch = refs[start : start + RESOLVE_BATCH_SIZE]
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/graphql",
+                    json={"query": resolve_query(batch)},
+                    timeout=FETCH_TIMEOUT,
+                )
+                data = response.json().get("data") if response.ok else None
+            except (requests.RequestException, ValueError):
+                return None
+            if data is None:
+                return None
+            for i, ref in enumerate(batch):
+                commit = (data.get(f"r{i}") or {}).get("object")
+                shas[ref] = commit["oid"] if commit else None
+        return shas
+
+
+class MirrorBackend:
+    """Reads files from a local mirror directory laid out as owner/repo/ref/path."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def fetch(self, owner, repo, ref, path, etag=None) -> FetchResult:
+        try:
+            with open(os.path.join(self.directory, owner, repo, ref, path), "rb") as f:
+                content = f.read()
+        except OSError:
+            return FetchResult(404)
+        content_etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if etag == content_etag:
+            return FetchResult(304, etag=etag)
+        return FetchResult(200, content, content_etag)
+
+    def resolve(self, owner, repo, ref) -> FetchResult:
+        """Mirrors have no history, refs resolve to a hash of their files instead."""
+        directory = os.path.join(self.directory, owner, repo, ref)
+        if not os.path.isdir(directory):
+            return FetchResult(404)
+        return FetchResult(200, mirror_commit(directory).encode())
+
+    def resolve_batch(
+        self, refs: list[tuple[str, str, str]]
+    ) -> dict[tuple[str, str, str], str | None]:
+        results = {ref: self.resolve(*ref) for ref in refs}
+        return {
+            ref: result.content.decode() if result.status == 200 else None
+            for ref, result in results.items()
+        }
+
+
+def resolve_query(refs: list[tuple[str, str, str]]) -> str:
+    """
+    GraphQL query for the commits of (owner, repo, ref) tuples, aliased r<index>.
+    Tags are peeled to the commits they point to.
+    """
+    # json strings are valid GraphQL strings
+    return (
+        "query {\n"
+        + "".join(
+            f"  r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(repo)})"
+            f" {{ object(expression: {json.dumps(ref + '^{commit}')}) {{ oid }} }}\n"
+            for i, (owner, repo, ref) in enumerate(refs)
+        )
+        + "}"
+    )
+
+
+def mirror_commit(directory: str) -> str:
+    """Stand-in commit SHA of a mirrored ref, a hash of its paths and contents."""
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, directory).encode() + b"\0")
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def get_backend(settings: Settings) -> HTTPBackend | MirrorBackend:
+    if settings.config_base_url.startswith("file://"):
+        return MirrorBackend(settings.config_base_url.removeprefix("file://"))
+    return HTTPBackend(
+        settings.config_base_url,
+        settings.token,
+        settings.fetch_workers,
+        settings.api_url,
+    )
+
+
+class ConfigFetcher:
+    """Fetches configs of packages concurrently, through the cache."""
+
+    def __init__(self, settings: Settings, backend=None, timings: Timings = None):
+        self.workers = settings.fetch_workers
+        self.backend = backend or get_backend(settings)
+        self.timings = timings or Timings()
+        self.cache = ConfigCache(
+            settings.config_cache_dir, settings.config_cache_max_age
+        )
+        self._shas: dict[tuple[str, str, str], str | None] = {}
+
+    # Get build-pacakge(-hpc) config for each repo
+    def get_config(self, owner, repo, pkg_name, ref, path):
+        """
+        Fetch the config of a package. Runs in worker threads, so messages are
+        returned in `log` and printed by the caller to keep the output in order.
+        """
+        return_obj = {
+            "pkg_name": pkg_name,
+            "matrix": [],
+            "setup_matrix": False,
+            "found": False,
+            "cache": None,
+            "status": None,
+            "bytes": 0,
+            "log": [f"Getting config for {pkg_name}:{owner}/{repo}@{ref}"],
+        }
+        if not path:
+            return_obj["log"].append(f"Config path not provided for {pkg_name}")
+            return_obj["setup_matrix"] = True
+            return return_obj
+
+        cache_key = f"{owner}/{repo}/{ref}/{path}"
+        cached = self.cache.get(cache_key)
+        if cached and self.cache.is_fresh(cached):
+            return_obj.update(matrix=cached["matrix"], setup_matrix=True, found=True)
+            return_obj["cache"] = "fresh"
+            return return_obj
+
+        result = self.backend.fetch(
+            owner, repo, ref, path, cached["etag"] if cached else None
+        )
+        return_obj["status"] = result.status
+        return_obj["bytes"] = len(result.content or b"")
+        if result.status is None:
+            return_obj["log"].append(
+                f"::warning::Config for {owner}/{repo}@{ref} not found."
+            )
+            return_obj["log"].append(result.error)
+            return return_obj
+
+        if result.status == 304 and cached:
+            self.cache.put(cache_key, cached["etag"], cached["matrix"])
+            return_obj.update(matrix=cached["matrix"], setup_matrix=True, found=True)
+            return_obj["cache"] = "revalidated"
+            return return_obj
+
+        if result.status == 200:
+            config = yaml_io.load(result.content.decode())
+            return_obj["matrix"] = config.get("matrix", [])
+            return_obj["setup_matrix"] = True
+            return_obj["found"] = True
+            return_obj["cache"] = "miss"
+            self.cache.put(cache_key, result.etag, return_obj["matrix"])
+            return return_obj
+
+        return_obj["log"].append(
+            f"::warning::Config for {owner}/{repo}@{ref} not found."
+        )
+        return_obj["log"].append(f"{result.status} {result.content}")
+        return return_obj
+
+    def get_configs(self, packages: list[dict]) -> list[dict]:
+        """Fetch configs of all packages concurrently, results are in input order."""
+
+        def get_config(p):
+            with self.timings.span("fetch", package=p["pkg_name"]) as span:
+                config = self.get_config(
+                    p["owner"], p["repo"], p["pkg_name"], p["ref"], p["path"]
+                )
+                span.update(
+                    status=config["status"],
+                    bytes=config["bytes"],
+                    cache=config["cache"],
+                )
+            return config
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(get_config, packages))
+
+    def resolve_refs(self, packages: list[dict]) -> dict[str, str | None]:
+        """
+        Commit SHA of the ref of every package, None if it can't be resolved. All
+        refs are resolved in one batch, SHAs are kept for the rest of the run.
+        """
+        refs = list(dict.fromkeys((p["owner"], p["repo"], p["ref"]) for p in packages))
+        missing = [ref for ref in refs if ref not in self._shas]
+        if missing:
+            with self.timings.span("resolve batch", refs=len(missing)) as span:
+                shas = self.backend.resolve_batch(missing)
+                span["ok"] = shas is not None
+            if shas is None:
+                print("::warning::Resolving refs in a batch failed, resolving each")
+                with self.timings.span("resolve each", refs=len(missing)):
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        results = list(
+                            executor.map(lambda r: self.backend.resolve(*r), missing)
+                        )
+                shas = {
+                    ref: result.content.decode() if result.status == 200 else None
+                    for ref, result in zip(missing, results)
+                }
+            self._shas.update(shas)
+        for owner, repo, ref in missing:
+            if self._shas[(owner, repo, ref)] is None:
+                print(f"::warning::Could not resolve {owner}/{repo}@{ref}")
+        return {
+            p["pkg_name"]: self._shas[(p["owner"], p["repo"], p["ref"])]
+            for p in packages
+        }
+
+
+def get_trigger_pkgs(dep_tree: dict, github_repository: str) -> list[str]:
+    trigger_repo = github_repository.split("/")[1]
+    return [
+        k
+        for k, v in dep_tree.items()
+        if v.get("repo", k) in [github_repository, trigger_repo]
+    ]
 
 
 def get_ci_group_pkgs(ci_group: str, dep_tree: dict) -> list[str]:
@@ -140,7 +574,7 @@ def get_ci_group_pkgs(ci_group: str, dep_tree: dict) -> list[str]:
         return [k for k, v in dep_tree.items() if v.get("type", "") == "cmake"]
 
     with open("ci-groups.yml", "r") as f:
-        ci_groups = yaml.safe_load(f)
+        ci_groups = yaml_io.load(f)
 
     if ci_group in ci_groups:
         return ci_groups[ci_group]
@@ -152,148 +586,587 @@ def get_ci_group_pkgs(ci_group: str, dep_tree: dict) -> list[str]:
     sys.exit(1)
 
 
-if skip_jobs:
-    matrix["name"] = [name for name in matrix["name"] if name not in skip_jobs]
-    matrix["include"] = [d for d in matrix["include"] if d["name"] not in skip_jobs]
+def is_use_master(settings: Settings) -> bool:
+    """
+    Whether to use master branch for dependencies, if triggered from master branch
+    (as defined in the config).
+    """
+    return (
+        settings.ci_config.get(settings.github_repository, {}).get(
+            "master_branch", DEFAULT_MASTER_BRANCH_NAME
+        )
+        == settings.trigger_ref_name
+    )
 
 
-matrices = {}
-py_codecov_platform = ""
+def select_profile(settings: Settings, use_master: bool) -> dict:
+    """
+    Matrix profile of the run: the PROFILE input, else full for runs triggered from
+    a master branch and DEFAULT_PROFILE for others.
+    """
+    name = settings.profile or ("full" if use_master else settings.default_profile)
+    if name != "full" and name not in settings.profiles:
+        print(
+            f"::error::Profile {name} not found, expected one of: "
+            + ", ".join(["full"] + [p for p in settings.profiles if p != "full"])
+        )
+        sys.exit(1)
+    print(f"Profile: {name}")
+    return settings.profiles.get(name) or {}
 
-# whether to use master branch for dependencies
-# if triggered from master branch (as defined in the config)
-use_master = (
-    ci_config.get(github_repository, {}).get(
-        "master_branch", DEFAULT_MASTER_BRANCH_NAME
-    )
-    == trigger_ref_name
-)
-print("use_master: ", use_master)
 
-for owner_repo, val in ci_config.items():
-    pkg_name = None
-    if ":" in owner_repo:
-        pkg_name, owner_repo = owner_repo.split(":")
+def apply_profile(matrices: dict[str, dict], profile: dict, trigger_pkgs: list[str]):
+    """
+    Limit the matrix entries of non-triggering packages in place. Compact matrices
+    are left as they are: entries of the shared include list of their platform
+    group would run as jobs of their own.
+    """
+    if not profile.get("platforms"):
+        return
+    dropped = 0
+    for package, matrix in matrices.items():
+        if package in trigger_pkgs or "include" not in matrix:
+            continue
+        kept = matrix["name"][: profile["platforms"]]
+        dropped += len(matrix["name"]) - len(kept)
+        matrix["name"] = kept
+        matrix["include"] = [d for d in matrix["include"] if d["name"] in kept]
+    print(f"Profile dropped {dropped} matrix entries")
 
-    if owner_repo.count("/") > 1:
-        owner, repo, subdir = owner_repo.split("/", maxsplit=2)
-    else:
-        subdir = ""
-        owner, repo = owner_repo.split("/", maxsplit=1)
 
-    if not pkg_name:
-        pkg_name = repo
+def resolve_packages(ci_config: dict, use_master: bool) -> list[dict]:
+    """Owner, repo, subdir, ref and config path of every package in CONFIG."""
+    packages = []
+    for owner_repo, val in ci_config.items():
+        pkg_name = None
+        if ":" in owner_repo:
+            pkg_name, owner_repo = owner_repo.split(":")
 
-    master_branch_name = val.get("master_branch", DEFAULT_MASTER_BRANCH_NAME)
-    develop_branch_name = val.get("develop_branch", DEFAULT_DEVELOP_BRANCH_NAME)
-    ref = master_branch_name if use_master else develop_branch_name
-    package_input = val.get("input", "")
-    if package_input:
-        _, ref = package_input.split("@")
+        if owner_repo.count("/") > 1:
+            owner, repo, subdir = owner_repo.split("/", maxsplit=2)
+        else:
+            subdir = ""
+            owner, repo = owner_repo.split("/", maxsplit=1)
 
-    path = val.get("path", "")
-    config = get_config(owner, repo, pkg_name, ref, path)
+        if not pkg_name:
+            pkg_name = repo
 
-    if not config["setup_matrix"]:
-        continue
+        master_branch_name = val.get("master_branch", DEFAULT_MASTER_BRANCH_NAME)
+        develop_branch_name = val.get("develop_branch", DEFAULT_DEVELOP_BRANCH_NAME)
+        ref = master_branch_name if use_master else develop_branch_name
+        package_input = val.get("input", "")
+        if package_input:
+            _, ref = package_input.split("@")
 
-    matrices[pkg_name] = copy.deepcopy(matrix)
+        packages.append(
+            {
+                "pkg_name": pkg_name,
+                "owner": owner,
+                "repo": repo,
+                "subdir": subdir,
+                "ref": ref,
+                "path": val.get("path", ""),
+                "val": val,
+            }
+        )
+    return packages
 
-    for opt in optional_matrix.get("name", []):
-        if val.get("optional_matrix", []) and opt in val.get("optional_matrix", []):
-            matrices[pkg_name]["name"].append(opt)
-            matrices[pkg_name]["include"].extend(
-                [d for d in optional_matrix.get("include") if d["name"] == opt]
-            )
 
-    if config["matrix"]:
-        matrices[pkg_name]["config"] = config["matrix"]
-
-    pkg_skip = tree_get_package_var("skip", dep_tree, pkg_name, workflow_name) or []
-    if pkg_skip:
-        matrices[pkg_name]["name"] = [
-            name for name in matrices[pkg_name]["name"] if name not in pkg_skip
-        ]
-        matrices[pkg_name]["include"] = [
-            d for d in matrices[pkg_name]["include"] if d["name"] not in pkg_skip
-        ]
+def filter_affected(
+    packages: list[dict],
+    dep_tree: dict,
+    workflow_name: str,
+    trigger_pkgs: list[str],
+    ci_group_pkgs: list[str],
+) -> list[dict]:
+    """
+    Packages changed, i.e. triggering packages and packages with an input, and their
+    dependents. Dependencies are built within the jobs of their dependents (see
+    build_dependencies), so packages outside of the affected set need no matrix.
+    """
+    changed_pkgs = trigger_pkgs + [
+        p["pkg_name"] for p in packages if p["val"].get("input")
+    ]
+    affected_pkgs = [
+        pkg
+        for pkg in get_dep_graph(dep_tree, workflow_name).affected(changed_pkgs)
+        if pkg in ci_group_pkgs
+    ]
+    print(f"Affected packages: {affected_pkgs}")
+    return [p for p in packages if p["pkg_name"] in affected_pkgs]
+
+
+def build_matrix(
+    package: dict, config: dict, settings: Settings, dep_tree: dict, matrix: dict
+) -> tuple[dict, list[dict]]:
+    """
+    Build matrix of a package, given the workflow matrix with skipped jobs removed.
+    Returns the matrix and its include list, which is not part of compact matrices.
+    """
+    pkg_name, ref, path, val = (package[k] for k in ("pkg_name", "ref", "path", "val"))
+    owner, repo, subdir = (package[k] for k in ("owner", "repo", "subdir"))
+    optional_matrix = settings.optional_matrix
+    names = package_entries(
+        matrix["name"],
+        optional_matrix.get("name", []),
+        val.get("optional_matrix") or [],
+        tree_get_package_var("skip", dep_tree, pkg_name, settings.workflow_name) or [],
+        settings.python_jobs if val.get("python", False) is True else None,
+    )
+    include = [
+        d
+        for d in matrix["include"] + optional_matrix.get("include", [])
+        if d["name"] in names
+    ]
+
     repo_subdir = f"{repo}/{subdir}" if subdir else repo
-    for index, item in enumerate(matrices[pkg_name]["include"]):
-        matrices[pkg_name]["include"][index][
-            "owner_repo_ref"
-        ] = f"{pkg_name}:{owner}/{repo_subdir}@{ref}"
-        matrices[pkg_name]["include"][index]["config_path"] = path
+    owner_repo_ref = f"{pkg_name}:{owner}/{repo_subdir}@{ref}"
+    if val.get("platform_group") is not None:
+        # compact: package specific values are single valued axes, the include
+        # list is written once per platform group
+        pkg_matrix = {
+            "name": names,
+            "owner_repo_ref": [owner_repo_ref],
+            "config_path": [path],
+        }
+    else:
+        pkg_matrix = {
+            **matrix,
+            "name": names,
+            "include": [
+                {**d, "owner_repo_ref": owner_repo_ref, "config_path": path}
+                for d in include
+            ],
+        }
+
+    if config["matrix"]:
+        pkg_matrix["config"] = config["matrix"]
 
     if val.get("python", False) is True:
-        matrices[pkg_name]["python_version"] = python_versions
-        if python_jobs:
-            matrices[pkg_name]["name"] = [
-                name for name in matrices[pkg_name]["name"] if name in python_jobs
-            ]
-            matrices[pkg_name]["include"] = [
-                d for d in matrices[pkg_name]["include"] if d["name"] in python_jobs
-            ]
-        if pkg_name in trigger_pkgs:
-            py_codecov_platform = (
-                matrices[pkg_name]["name"][0] if len(matrices[pkg_name]["name"]) else ""
+        pkg_matrix["python_version"] = settings.python_versions
+    return pkg_matrix, include
+
+
+def build_dep_tree(dep_tree: dict, workflow_name: str) -> dict:
+    """
+    Dependency tree passed to build-package-hpc for downstream-ci-hpc, and to
+    build-package otherwise.
+    """
+    hpc = workflow_name == "downstream-ci-hpc"
+    tree_name = "downstream-ci-hpc" if hpc else "downstream-ci"
+    workflow_dep_tree = {}
+
+    for package in dep_tree:
+        workflow_dep_tree[package] = {}
+        if deps := tree_get_package_var("deps", dep_tree, package, tree_name):
+            workflow_dep_tree[package]["deps"] = deps
+
+        if hpc and (
+            modules := tree_get_package_var("modules", dep_tree, package, tree_name)
+        ):
+            workflow_dep_tree[package]["modules"] = modules
+
+    return workflow_dep_tree
+
+
+def dep_subtree(tree: dict, package: str) -> dict:
+    """A package and its dependencies, recursively, in the order of the tree."""
+    subtree = set()
+    stack = [package]
+    while stack:
+        pkg = stack.pop()
+        if pkg in subtree or pkg not in tree:
+            continue
+        subtree.add(pkg)
+        stack.extend(tree[pkg].get("deps", []))
+    return {pkg: val for pkg, val in tree.items() if pkg in subtree}
+
+
+def build_key(content: list) -> str:
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:40]
+
+
+def compute_build_keys(
+    shas: dict[str, str | None],
+    dep_tree: dict,
+    workflow_name: str,
+    settings: Settings,
+    matrices: dict[str, dict],
+) -> dict[str, dict[str, dict[str, str]]]:
+    """
+    Build keys of every package with a matrix, for each combination of its matrix
+    values, see build_keys output. Keys are computed in topological order, deps
+    first. Packages whose ref couldn't be resolved, or one of their dependencies',
+    get no keys: a key of a moving branch would hit stale caches. So do packages
+    depending on packages setup doesn't resolve, e.g. `input: false` ones or
+    private ones in public workflows.
+    """
+    graph = get_dep_graph(dep_tree, workflow_name)
+    entries = {
+        d["name"]: d
+        for d in settings.matrix["include"]
+        + settings.optional_matrix.get("include", [])
+    }
+    keys: dict[str, dict[str, str]] = {}
+    for package in graph.topological_order:
+        if package not in shas:
+            continue  # not built by this workflow
+        deps = graph.direct_deps(package)
+        if shas[package] is None or any(dep not in keys for dep in deps):
+            continue
+        modules = tree_get_package_var("modules", dep_tree, package, workflow_name)
+        keys[package] = {
+            name: build_key(
+                [
+                    package,
+                    shas[package],
+                    entry,
+                    modules,
+                    [keys[dep][name] for dep in deps],
+                ]
             )
+            for name, entry in entries.items()
+        }
 
+    build_keys = {}
+    for package, matrix in matrices.items():
+        if package not in keys:
+            continue
+        configs = matrix.get("config", [""])
+        python_versions = matrix.get("python_version", [""])
+        build_keys[package] = {
+            name: {
+                f"{config}/{python_version}": build_key(
+                    [keys[package][name], config, python_version]
+                )
+                for config in configs
+                for python_version in python_versions
+            }
+            for name in matrix["name"]
+        }
+    return build_keys
 
-build_package_dep_tree = {}
-build_package_hpc_dep_tree = {}
 
+def format_outputs(
+    trigger_repo: str,
+    trigger_pkgs: list[str],
+    py_codecov_platform: str,
+    use_master: bool,
+    ci_group_pkgs: list[str],
+    matrices: dict[str, dict],
+    platforms: dict[str, list[dict]],
+    resolved_refs: dict[str, str | None] | None = None,
+    build_keys: dict[str, dict[str, dict[str, str]]] | None = None,
+    platform_major: bool = False,
+    package_dep_trees: dict[str, dict] | None = None,
+) -> dict[str, tuple[str, bool]]:
+    """
+    Outputs of the setup step, values with whether they are written multiline.
+    In platform-major workflows, matrices are split into one per matrix entry,
+    output as <package>_<platform slug>.
+    """
+    outputs = {
+        "trigger_repo": (trigger_repo, False),
+        "trigger_pkgs": (str(trigger_pkgs), False),
+        "py_codecov_platform": (py_codecov_platform, False),
+        "use_master": (str(use_master), False),
+        "ci_group_pkgs": (json.dumps(ci_group_pkgs, separators=(",", ":")), True),
+    }
+    for key, value in matrices.items():
+        if platform_major and "include" in value:
+            for name in value["name"]:
+                entry = {
+                    **value,
+                    "name": [name],
+                    "include": [d for d in value["include"] if d["name"] == name],
+                }
+                if "exclude" in value:
+                    entry["exclude"] = [
+                        d for d in value["exclude"] if d["name"] == name
+                    ]
+                outputs[f"{key}_{platform_slug(name)}"] = (
+                    json.dumps(entry, separators=(",", ":")),
+                    True,
+                )
+            continue
+        value = json.dumps(value, separators=(",", ":"))
+        if "include" not in matrices[key]:
+            # compact, members of the matrix object, see platform_group
+            value = value[1:-1]
+        outputs[key] = (value, True)
+    for key, value in (package_dep_trees or {}).items():
+        outputs[f"{key}_dep_tree"] = (json.dumps(value, separators=(",", ":")), False)
+    for group, include in platforms.items():
+        outputs[f"platforms_{group}"] = (
+            json.dumps(include, separators=(",", ":")),
+            True,
+        )
+    if resolved_refs is not None:
+        outputs["resolved_refs"] = (
+            json.dumps(resolved_refs, separators=(",", ":")),
+            True,
+        )
+    if build_keys is not None:
+        outputs["build_keys"] = (json.dumps(build_keys, separators=(",", ":")), True)
+    return outputs
 
-for package, conf in dep_tree.items():
-    build_package_dep_tree[package] = {}
-    if bp_deps := tree_get_package_var("deps", dep_tree, package, "downstream-ci"):
-        build_package_dep_tree[package]["deps"] = bp_deps
 
-    build_package_hpc_dep_tree[package] = {}
-    if hpc_deps := tree_get_package_var("deps", dep_tree, package, "downstream-ci-hpc"):
-        build_package_hpc_dep_tree[package]["deps"] = hpc_deps
+def write_outputs(path: str, outputs: dict[str, tuple[str, bool]]):
+    with open(path, "a") as f:
+        for key, (value, multiline) in outputs.items():
+            if multiline:
+                print(f"{key}<<EOF", value, "EOF", sep="\n", file=f)
+            else:
+                print(key, value, sep="=", file=f)
 
-    if hpc_modules := tree_get_package_var(
-        "modules", dep_tree, package, "downstream-ci-hpc"
-    ):
-        build_package_hpc_dep_tree[package]["modules"] = hpc_modules
 
+def check_output_sizes(sizes: dict[str, int]):
+    """Warn about outputs approaching github's limits, fail if they exceed them."""
+    total = sum(sizes.values())
+    largest = max(sizes, key=sizes.get)
+    print(f"Outputs: {total} bytes, largest {largest} ({sizes[largest]} bytes)")
+    exceeded = False
+    for key, size in sizes.items():
+        if size > OUTPUT_SIZE_LIMIT:
+            print(f"::error::Output {key} exceeds {OUTPUT_SIZE_LIMIT} bytes: {size}")
+            exceeded = True
+        elif size > OUTPUT_SIZE_LIMIT * OUTPUT_SIZE_WARNING:
+            print(f"::warning::Output {key} is close to the size limit: {size} bytes")
+    if total > OUTPUTS_TOTAL_LIMIT:
+        print(f"::error::Outputs exceed {OUTPUTS_TOTAL_LIMIT} bytes in total: {total}")
+        exceeded = True
+    elif total > OUTPUTS_TOTAL_LIMIT * OUTPUT_SIZE_WARNING:
+        print(f"::warning::Outputs are close to the total size limit: {total} bytes")
+    if exceeded:
+        print("Consider setting `compact_matrix: true` for the workflow in config.yml")
+        sys.exit(1)
 
-print("Build matrices:")
-yaml.Dumper.ignore_aliases = lambda *args: True
-print(yaml.dump(matrices, sort_keys=False))
 
-print(
-    "build-package dependency tree:\n",
-    yaml.dump(build_package_dep_tree, sort_keys=False),
-)
-print(
-    "build-package-hpc dependency tree:\n",
-    yaml.dump(build_package_hpc_dep_tree, sort_keys=False),
-)
-print(f"Python codecov platform: {py_codecov_platform}")
+def process_age() -> float | None:
+    """Seconds since the process started, None where /proc isn't available."""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # starttime is the 22nd field, the command name before it may have spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
 
-ci_group_pkgs = get_ci_group_pkgs(ci_group, dep_tree)
-print(f"CI group packages: {ci_group_pkgs}")
+def reduce_matrices(
+    matrices: dict[str, dict], settings: Settings, trigger_pkgs: list[str]
+):
+    """Reduce matrices of non-triggering packages in place and report the savings."""
+    full = reduced = 0
+    for package, matrix in matrices.items():
+        if package in trigger_pkgs:
+            continue
+        package_full, package_reduced = reduce_matrix(
+            matrix, settings.covering_strength
+        )
+        full += package_full
+        reduced += package_reduced
+        if package_reduced < package_full:
+            print(f"  {package}: {package_reduced} of {package_full} jobs")
+    print(
+        f"Covering arrays of strength {settings.covering_strength}: {reduced} of "
+        f"{full} jobs, {full - reduced} saved"
+    )
 
-with open(os.getenv("GITHUB_OUTPUT"), "a") as f:
-    print("trigger_repo", trigger_repo, sep="=", file=f)
-    print("trigger_pkgs", trigger_pkgs, sep="=", file=f)
-    print("py_codecov_platform", py_codecov_platform, sep="=", file=f)
-    print("use_master", use_master, sep="=", file=f)
 
-    print("ci_group_pkgs<<EOF", file=f)
-    print(json.dumps(ci_group_pkgs, separators=(",", ":")), file=f)
-    print("EOF", file=f)
+def balance_runners(
+    matrices: dict[str, dict],
+    dep_tree: dict,
+    settings: Settings,
+    trigger_pkgs: list[str],
+):
+    """Report the projected load of runners and balance matrices in place."""
+    graph = get_dep_graph(dep_tree, settings.workflow_name)
+    waves = get_waves(graph, list(matrices))
+    labels = entry_labels(
+        settings.matrix["include"] + settings.optional_matrix.get("include", []),
+        settings.runner_capacity,
+    )
+    loads = project_load(matrices, waves, labels, settings.runner_capacity)
+    print("Projected runner load:", format_load(loads), sep="\n")
+    overloaded = [load.label for load in loads if load.queue_depth]
+    if not settings.balance_matrix or not overloaded:
+        return
+    dropped = balance(
+        matrices,
+        waves,
+        labels,
+        settings.runner_capacity,
+        settings.balance_matrix,
+        trigger_pkgs,
+    )
+    print(f"Dropped {len(dropped)} matrix entries of overloaded runners:")
+    for package, name in dropped:
+        print(f"  {package}: {name}")
+    loads = project_load(matrices, waves, labels, settings.runner_capacity)
+    print("Projected runner load after balancing:", format_load(loads), sep="\n")
 
-    print("build_package_dep_tree<<EOF", file=f)
-    print(yaml.dump(build_package_dep_tree), file=f)
-    print("EOF", file=f)
 
-    print("build_package_hpc_dep_tree<<EOF", file=f)
-    print(yaml.dump(build_package_hpc_dep_tree), file=f)
-    print("EOF", file=f)
+def write_timings(timings: Timings, settings: Settings):
+    """Write timings as json to TIMINGS_FILE and a summary to the job summary."""
+    if settings.timings_file:
+        with open(settings.timings_file, "w") as f:
+            json.dump(timings.to_dict(), f, indent=2)
+    if settings.step_summary:
+        with open(settings.step_summary, "a") as f:
+            f.write(timings.format_summary(f"Setup {settings.workflow_name}", "fetch"))
 
-    for key, value in matrices.items():
-        print(f"{key}<<EOF", file=f)
-        print(json.dumps(value, separators=(",", ":")), file=f)
-        print("EOF", file=f)
+
+def main():
+    timings = Timings(process_age())
+    with timings.span("load inputs"):
+        settings = Settings.from_env()
+        with open("dependency_tree.yml", "r") as f:
+            dep_tree = yaml_io.load(f)
+    trigger_repo = settings.trigger_repo
+    print(f"Triggered from: {trigger_repo}")
+
+    with timings.span("select packages"):
+        trigger_pkgs = get_trigger_pkgs(dep_tree, settings.github_repository)
+        print(f"Trigger packages: {trigger_pkgs}")
+
+        matrix = settings.matrix
+        if settings.skip_jobs:
+            matrix = {
+                **matrix,
+                "name": [n for n in matrix["name"] if n not in settings.skip_jobs],
+                "include": [
+                    d for d in matrix["include"] if d["name"] not in settings.skip_jobs
+                ],
+            }
+
+        use_master = is_use_master(settings)
+        print("use_master: ", use_master)
+        profile = select_profile(settings, use_master)
+
+        ci_group_pkgs = get_ci_group_pkgs(settings.ci_group, dep_tree)
+        print(f"CI group packages: {ci_group_pkgs}")
+
+        packages = all_packages = resolve_packages(settings.ci_config, use_master)
+        if settings.affected_only:
+            packages = filter_affected(
+                packages, dep_tree, settings.workflow_name, trigger_pkgs, ci_group_pkgs
+            )
+
+    fetcher = ConfigFetcher(settings, timings=timings)
+    with timings.span("fetch configs", packages=len(packages)):
+        configs = fetcher.get_configs(packages)
+    if settings.config_cache_dir:
+        cache = [c["cache"] for c in configs]
+        print(
+            f"Config cache: {cache.count('fresh') + cache.count('revalidated')} hits "
+            f"({cache.count('fresh')} fresh, {cache.count('revalidated')} "
+            f"revalidated), {cache.count('miss')} misses"
+        )
+
+    matrices = {}
+    platforms = {}
+    py_codecov_platform = ""
+    with timings.span("build matrices"):
+        for package, config in zip(packages, configs):
+            pkg_name, path, val = package["pkg_name"], package["path"], package["val"]
+            print(*config["log"], sep="\n")
+            if path and not config["found"] and pkg_name in trigger_pkgs:
+                print(
+                    f"::error::Config file {path} for triggering package {pkg_name} "
+                    "not found"
+                )
+                sys.exit(1)
+
+            if not config["setup_matrix"]:
+                continue
+
+            matrices[pkg_name], include = build_matrix(
+                package, config, settings, dep_tree, matrix
+            )
+            if val.get("platform_group") is not None:
+                platforms[val["platform_group"]] = include
+            if val.get("python", False) is True and pkg_name in trigger_pkgs:
+                names = matrices[pkg_name]["name"]
+                py_codecov_platform = names[0] if len(names) else ""
+
+    apply_profile(matrices, profile, trigger_pkgs)
+    settings.covering_strength = profile.get(
+        "covering_strength", settings.covering_strength
+    )
+    if settings.covering_strength:
+        with timings.span("reduce matrices"):
+            reduce_matrices(matrices, settings, trigger_pkgs)
+
+    if settings.runner_capacity:
+        with timings.span("balance runners"):
+            balance_runners(matrices, dep_tree, settings, trigger_pkgs)
+
+    with timings.span("build dependency trees"):
+        workflow_dep_tree = build_dep_tree(dep_tree, settings.workflow_name)
+        package_dep_trees = {
+            package: dep_subtree(workflow_dep_tree, package) for package in matrices
+        }
+
+    shas = build_keys = None
+    if settings.resolve_refs or settings.build_keys:
+        # dependencies of affected packages are built as well, resolve all refs
+        with timings.span("resolve refs", packages=len(all_packages)):
+            shas = fetcher.resolve_refs(all_packages)
+        print("Resolved refs:")
+        print(yaml_io.dump(shas, sort_keys=False))
+    if settings.build_keys:
+        with timings.span("compute build keys"):
+            build_keys = compute_build_keys(
+                shas, dep_tree, settings.workflow_name, settings, matrices
+            )
+
+    print("Build matrices:")
+    print(yaml_io.dump(matrices, sort_keys=False))
+    if platforms:
+        print("Platform groups:")
+        print(yaml_io.dump(platforms, sort_keys=False))
+
+    print(
+        f"{settings.workflow_name} dependency tree:\n",
+        yaml_io.dump(workflow_dep_tree, sort_keys=False),
+    )
+    print(f"Python codecov platform: {py_codecov_platform}")
+
+    with timings.span("format outputs"):
+        outputs = format_outputs(
+            trigger_repo,
+            trigger_pkgs,
+            py_codecov_platform,
+            use_master,
+            ci_group_pkgs,
+            matrices,
+            platforms,
+            shas,
+            build_keys,
+            settings.platform_major,
+            package_dep_trees,
+        )
+        sizes = {k: len(v.encode()) for k, (v, _) in outputs.items()}
+    check_output_sizes(sizes)
+    with timings.span("write outputs", bytes=sum(sizes.values())):
+        write_outputs(os.getenv("GITHUB_OUTPUT"), outputs)
+
+    write_timings(timings, settings)
+    # cold start: interpreter start up and imports, before main() is called
+    print(
+        "Setup took "
+        + (
+            f"{timings.startup:.3f} s to start and "
+            if timings.startup is not None
+            else ""
+        )
+        + f"{timings.elapsed:.3f} s to run"
+        + (" (requests imported)" if "requests" in sys.modules else "")
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Timing spans of the phases of a run, e.g. of setup_downstream_ci.py.
+
+Spans are recorded relative to the start of the run, with free-form attributes like
+HTTP status or cache hits. They can be dumped as json and summarised as Markdown
+tables, for $GITHUB_STEP_SUMMARY.
+"""
+
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+SLOWEST_SPANS = 10  # spans of a kind listed individually in summaries
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # seconds since the start of the run
+    duration: float
+    attrs: dict = field(default_factory=dict)
+
+
+class Timings:
+    """Spans of a run, spans may be recorded from multiple threads."""
+
+    def __init__(self, startup: float | None = None):
+        self.origin = time.perf_counter()
+        # interpreter start up and imports, before the timings were created
+        self.startup = startup
+        self.spans: list[Span] = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a with block, the yielded dict of attributes can be extended."""
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            # list.append is atomic, no lock needed between worker threads
+            self.spans.append(Span(name, start - self.origin, end - start, attrs))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.origin
+
+    def to_dict(self) -> dict:
+        spans = [asdict(s) for s in sorted(self.spans, key=lambda s: s.start)]
+        for span in spans:
+            span["start"] = round(span["start"], 6)
+            span["duration"] = round(span["duration"], 6)
+        return {
+            "startup": None if self.startup is None else round(self.startup, 6),
+            "total": round(self.elapsed, 6),
+            "spans": spans,
+        }
+
+    def format_summary(self, title: str, detail: str) -> str:
+        """
+        Markdown tables of the spans: totals per span name, and the slowest spans
+        named `detail` with their attributes.
+        """
+        totals: dict[str, list[float]] = {}
+        for span in sorted(self.spans, key=lambda s: s.start):
+            totals.setdefault(span.name, []).append(span.duration)
+        started = (
+            f"Started in {self.startup:.3f} s, ran"
+            if self.startup is not None
+            else "Ran"
+        )
+        lines = [
+            f"### {title}",
+            "",
+            f"{started} in {self.elapsed:.3f} s.",
+            "",
+            "| Phase | Count | Total (s) | Max (s) |",
+            "| --- | ---: | ---: | ---: |",
+        ]
+        for name, durations in totals.items():
+            lines.append(
+                f"| {name} | {len(durations)} | {sum(durations):.3f} "
+                f"| {max(durations):.3f} |"
+            )
+
+        slowest = sorted(
+            (s for s in self.spans if s.name == detail),
+            key=lambda s: s.duration,
+            reverse=True,
+        )[:SLOWEST_SPANS]
+        if slowest:
+            keys = list(dict.fromkeys(k for s in slowest for k in s.attrs))
+            lines += [
+                "",
+                f"Slowest {detail} spans:",
+                "",
+                "| " + " | ".join(keys) + " | Duration (s) |",
+                "| " + " | ".join("---" for _ in keys) + " | ---: |",
+            ]
+            for span in slowest:
+                values = [
+                    "" if span.attrs.get(k) is None else str(span.attrs[k])
+                    for k in keys
+                ]
+                lines.append("| " + " | ".join(values) + f" | {span.duration:.3f} |")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,64 @@
+"""
+YAML loading and dumping shared by generate-workflows.py and setup_downstream_ci.py.
+
+Uses the libyaml based loader and dumper when PyYAML was built with it, and falls back
+to the pure python implementation otherwise. Both produce the same output.
+"""
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as _SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+
+    # libyaml takes the line width as an int, negative meaning unlimited
+    _UNLIMITED_WIDTH = -1
+except ImportError:
+    from yaml import SafeDumper as _SafeDumper
+    from yaml import SafeLoader
+
+    _UNLIMITED_WIDTH = float("inf")
+
+
+class Dumper(_SafeDumper):
+    """Never emits anchors and aliases, github workflows don't support them."""
+
+    def ignore_aliases(self, data):
+        return True
+
+
+class BlockDumper(Dumper):
+    """Dumps multiline strings as `|` block scalars."""
+
+
+# modify how pyyaml dumps multiline strings - we want `|`
+def str_presenter(dumper, data):
+    if len(data.splitlines()) > 1:  # check for multiline string
+        return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
+    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+
+
+BlockDumper.add_representer(str, str_presenter)
+
+
+def add_state_representer(cls: type):
+    """Dump instances of given class as the mapping returned by their __getstate__."""
+    BlockDumper.add_representer(
+        cls, lambda dumper, data: dumper.represent_dict(data.__getstate__())
+    )
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None, block_strings=False, **kwargs):
+    """
+    Same as yaml.dump, `block_strings` dumps multiline strings as `|` block scalars.
+    `width=float("inf")` disables line wrapping.
+    """
+    if kwargs.get("width") == float("inf"):
+        kwargs["width"] = _UNLIMITED_WIDTH
+    return yaml.dump(
+        data, stream, Dumper=BlockDumper if block_strings else Dumper, **kwargs
+    )